@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+"""
+This is the "accumulators" module.
+
+Streaming versions of the indicators computed by etf-backtest.py. Each
+accumulator takes one bar at a time and updates in O(1), or amortized O(1),
+instead of rescanning its window, and its state can be serialized with dumps()
+and restored with loads() so it can be checkpointed between runs.
+
+RollingReturn and ParabolicSar do the same arithmetic as the batch code and
+return identical values. RollingVolatility and UlcerIndex update running sums,
+so they agree with indicators.rolling_std and indicators.rolling_ulcer_index
+to within rounding rather than bit for bit.
+
+sample usage:
+>>> import accumulators
+>>> ret = accumulators.RollingReturn(20)
+>>> for price in prices:
+...     value = ret.update(price)
+>>> text = accumulators.dumps(ret)
+>>> ret = accumulators.loads(text)
+"""
+
+import json
+from collections import deque
+
+
+class RollingReturn:
+    """
+    Return over the last days bars: (p[t] - p[t - days]) / p[t - days].
+    """
+
+    # Constructor arguments, restored from the state by loads().
+    ARGS = ('days',)
+
+    def __init__(self, days):
+        self.days = days
+        self.prices = deque()
+
+    def update(self, price):
+        """
+        Adds a price and returns the return ending at it, or None until
+        days + 1 prices have been seen.
+        """
+        self.prices.append(price)
+        if len(self.prices) > self.days + 1:
+            self.prices.popleft()
+        return self.value()
+
+    def value(self):
+        if len(self.prices) <= self.days:
+            return None
+        first = self.prices[0]
+        return (self.prices[-1] - first) / first
+
+    def state(self):
+        return {'days': self.days, 'prices': list(self.prices)}
+
+    def restore(self, state):
+        self.days = state['days']
+        self.prices = deque(state['prices'])
+
+
+class RollingVolatility:
+    """
+    Population standard deviation of the last size values, times scale. The
+    mean and sum of squared deviations are updated with Welford's method as
+    values enter and leave the window, and recomputed from the window once
+    every size values so rounding errors do not accumulate.
+    """
+
+    # Constructor arguments, restored from the state by loads().
+    ARGS = ('size', 'scale')
+
+    def __init__(self, size, scale=1.):
+        self.size = size
+        self.scale = scale
+        self.values = deque()
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def update(self, x):
+        """
+        Adds a value and returns the volatility of the window ending at it,
+        or None until size values have been seen.
+        """
+        self.values.append(x)
+        n = len(self.values)
+        d = x - self.mean
+        self.mean += d / n
+        self.m2 += d * (x - self.mean)
+        if n > self.size:
+            y = self.values.popleft()
+            n -= 1
+            d = y - self.mean
+            self.mean -= d / n
+            self.m2 -= d * (y - self.mean)
+        self.count += 1
+        if self.count % self.size == 0:
+            self.mean = sum(self.values) / n
+            self.m2 = sum((v - self.mean) ** 2 for v in self.values)
+        return self.value()
+
+    def value(self):
+        if len(self.values) < self.size:
+            return None
+        return (max(self.m2, 0.) / len(self.values)) ** 0.5 * self.scale
+
+    def state(self):
+        return {'size': self.size, 'scale': self.scale, 'values': list(self.values), 'count': self.count,
+                'mean': self.mean, 'm2': self.m2}
+
+    def restore(self, state):
+        self.size = state['size']
+        self.scale = state['scale']
+        self.values = deque(state['values'])
+        self.count = state['count']
+        self.mean = state['mean']
+        self.m2 = state['m2']
+
+
+class UlcerIndex:
+    """
+    Ulcer index of the last size prices: drawdowns in percent against the
+    running maximum since the start of the window, squared, summed, divided
+    by n (size by default) and square rooted.
+
+    The window is split into segments at its prefix maximum records, the
+    prices that exceed every earlier price in the window, and the squared
+    drawdowns of each segment are kept against its record. A new price either
+    starts a segment or extends the last one. When the oldest price leaves,
+    only its segment changes: the records between it and the next record are
+    found by following next-greater pointers, which are maintained with a
+    monotonic stack, and their segments are summed from prefix sums. Each
+    price becomes a record at most once while it is in the window, so updates
+    are amortized O(1). The prefix sums are rebased on the window's first
+    price once every size prices, which keeps them small and accurate.
+    """
+
+    # Constructor arguments, restored from the state by loads().
+    ARGS = ('size', 'n')
+
+    def __init__(self, size, n=None):
+        self.size = size
+        self.n = size if n is None else n
+        self.count = 0           # prices seen; the window holds indices count - len(prices) .. count - 1
+        self.base = None         # prefix sums are of price - base, to keep them small
+        self.prices = {}         # index -> price
+        self.sums = {}           # index -> (sum, sum of squares) of price - base up to and including index
+        self.before = (0., 0.)   # the prefix sums just before the window
+        self.next_greater = {}   # index -> index of the next strictly greater price, once one has arrived
+        self.stack = deque()     # indices still waiting for a greater price, in decreasing price order
+        self.records = deque()   # prefix maximum records of the window, starting with its first index
+        self.segments = deque()  # sum of squared drawdowns from each record up to the next one
+        self.total = 0.
+
+    def update(self, price):
+        """
+        Adds a price and returns the ulcer index of the window ending at it,
+        or None until size prices have been seen.
+        """
+        i = self.count
+        self.count += 1
+        if self.base is None:
+            self.base = price
+        y = price - self.base
+        prev = self.sums.get(i - 1, self.before)
+        self.prices[i] = price
+        self.sums[i] = (prev[0] + y, prev[1] + y * y)
+
+        while self.stack and self.prices[self.stack[-1]] < price:
+            self.next_greater[self.stack.pop()] = i
+        self.stack.append(i)
+
+        if not self.records or price > self.prices[self.records[-1]]:
+            self.records.append(i)
+            self.segments.append(0.)
+        else:
+            peak = self.prices[self.records[-1]]
+            dd = (100 * (price - peak) / peak) ** 2
+            self.segments[-1] += dd
+            self.total += dd
+
+        if len(self.prices) > self.size:
+            self._drop_first()
+        if self.count % self.size == 0:
+            self._rebase()
+        return self.value()
+
+    def _rebase(self):
+        first = self.count - len(self.prices)
+        self.base = self.prices[first]
+        self.before = s1, s2 = (0., 0.)
+        for i in range(first, self.count):
+            y = self.prices[i] - self.base
+            s1, s2 = s1 + y, s2 + y * y
+            self.sums[i] = (s1, s2)
+        self.total = sum(self.segments)
+
+    def _segment(self, start, stop):
+        # Squared drawdowns of prices start .. stop - 1 against the price at start.
+        peak = self.prices[start]
+        m = peak - self.base
+        lo = self.sums.get(start - 1, self.before)
+        hi = self.sums[stop - 1]
+        k = stop - start
+        s1, s2 = hi[0] - lo[0], hi[1] - lo[1]
+        return max(s2 - 2 * m * s1 + k * m * m, 0.) * 10000 / (peak * peak)
+
+    def _drop_first(self):
+        first = self.records.popleft()
+        self.total -= self.segments.popleft()
+        if self.stack and self.stack[0] == first:
+            self.stack.popleft()
+        self.next_greater.pop(first, None)
+        self.before = self.sums.pop(first)
+        del self.prices[first]
+
+        stop = self.records[0] if self.records else self.count
+        new = []
+        j = first + 1
+        while j is not None and j < stop:
+            new.append(j)
+            j = self.next_greater.get(j)
+        for k in reversed(range(len(new))):
+            seg = self._segment(new[k], new[k + 1] if k + 1 < len(new) else stop)
+            self.records.appendleft(new[k])
+            self.segments.appendleft(seg)
+            self.total += seg
+
+    def value(self):
+        if len(self.prices) < self.size:
+            return None
+        return (max(self.total, 0.) / self.n) ** 0.5
+
+    def state(self):
+        return {
+            'size': self.size, 'n': self.n, 'count': self.count, 'base': self.base,
+            'prices': sorted(self.prices.items()), 'sums': sorted(self.sums.items()), 'before': self.before,
+            'next_greater': sorted(self.next_greater.items()), 'stack': list(self.stack),
+            'records': list(self.records), 'segments': list(self.segments), 'total': self.total,
+        }
+
+    def restore(self, state):
+        self.size = state['size']
+        self.n = state['n']
+        self.count = state['count']
+        self.base = state['base']
+        self.prices = dict(state['prices'])
+        self.sums = dict((i, tuple(s)) for i, s in state['sums'])
+        self.before = tuple(state['before'])
+        self.next_greater = dict(state['next_greater'])
+        self.stack = deque(state['stack'])
+        self.records = deque(state['records'])
+        self.segments = deque(state['segments'])
+        self.total = state['total']
+
+
+class ParabolicSar:
+    """
+    The Parabolic SAR state machine of indicators.parabolic_sar, one bar at a
+    time. The first position is opened at the first significant high or low
+    point and, as in the batch version, a bar is only processed once the two
+    bars after it have arrived.
+    """
+
+    # Constructor arguments, restored from the state by loads().
+    ARGS = ()
+
+    def __init__(self):
+        self.count = 0
+        self.bars = deque(maxlen=4)  # the last (dt, high, low) bars
+        self.opened = False
+        self.start = None
+        self.position = None
+        self.sar = None
+        self.af = None
+        self.ep = None
+
+    def update(self, dt, high, low):
+        """
+        Adds a bar and returns the (dt, long_short, parabolic_sar) row of the
+        bar that became ready, or None.
+        """
+        self.bars.append((dt, high, low))
+        self.count += 1
+        # Bar t = count - 3 is ready; the window holds bars t - 1 .. t + 2.
+        t = self.count - 3
+        if t < 1:
+            return None
+        (dt0, high0, low0), (dt1, high1, low1), (dt2, high2, low2) = list(self.bars)[:3]
+        if not self.opened:
+            # A significant point at t is a high above both neighbours or a low below both, but not both.
+            hip = high0 < high1 and high1 > high2
+            lop = low0 > low1 and low1 < low2
+            if hip != lop:
+                self.opened = True
+                self.start = t + 1
+                self.position = 'L' if lop else 'S'
+                self.sar = low1 if lop else high1
+                self.ep = high2 if lop else low2
+                self.af = 0.02
+            return None
+        if t < self.start:
+            return None
+        return self._step(dt1, high0, low0, high1, low1)
+
+    def _step(self, dt, high1, low1, high2, low2):
+        row = (dt, self.position, self.sar)
+        sar, af, ep = self.sar, self.af, self.ep
+        if self.position == 'L':
+            if sar > low2:
+                self.position = 'S'
+                af = 0.02
+                sar, ep = ep, low2
+            else:
+                new_ep = high2 > ep
+                if new_ep:
+                    ep = high2
+                af_diff = af * (ep - sar)
+                if new_ep:
+                    af = min(af + 0.02, 0.2)
+                sar += af_diff
+                if sar > low1 or sar > low2:
+                    sar = min(low1, low2)
+        else:
+            if sar < high2:
+                self.position = 'L'
+                af = 0.02
+                sar, ep = ep, high2
+            else:
+                new_ep = low2 < ep
+                if new_ep:
+                    ep = low2
+                af_diff = af * (sar - ep)
+                if new_ep:
+                    af = min(af + 0.02, 0.2)
+                sar -= af_diff
+                if sar < high1 or sar < high2:
+                    sar = max(high1, high2)
+        self.sar, self.af, self.ep = sar, af, ep
+        return row
+
+    def state(self):
+        return {
+            'count': self.count, 'bars': [[str(dt), high, low] for dt, high, low in self.bars],
+            'opened': self.opened, 'start': self.start, 'position': self.position,
+            'sar': self.sar, 'af': self.af, 'ep': self.ep,
+        }
+
+    def restore(self, state):
+        self.count = state['count']
+        self.bars = deque((tuple(bar) for bar in state['bars']), maxlen=4)
+        self.opened = state['opened']
+        self.start = state['start']
+        self.position = state['position']
+        self.sar = state['sar']
+        self.af = state['af']
+        self.ep = state['ep']
+
+
+ACCUMULATORS = dict((cls.__name__, cls) for cls in (RollingReturn, RollingVolatility, UlcerIndex, ParabolicSar))
+
+
+def dumps(accumulator):
+    """
+    Returns accumulator's class and state as a JSON string.
+    """
+    return json.dumps({'class': accumulator.__class__.__name__, 'state': accumulator.state()})
+
+
+def loads(text):
+    """
+    Returns the accumulator serialized by dumps(), ready to take the next
+    bar.
+    """
+    data = json.loads(text)
+    cls, state = ACCUMULATORS[data['class']], data['state']
+    accumulator = cls(*[state[arg] for arg in cls.ARGS])
+    accumulator.restore(state)
+    return accumulator
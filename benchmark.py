@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+This is the "benchmark" module.
+
+It times the etf-backtest.py pipeline on synthetic market data, so runs need no
+network access and are reproducible from a seed. Every stage, screener and
+backtest is timed and the results are printed as JSON.
+
+sample usage:
+$ python benchmark.py --symbols 100 --years 8 --seed 1 > bench-100.json
+$ python benchmark.py --symbols 1000 --years 8 --output bench-1000.json
+"""
+
+import argparse
+import datetime
+import imp
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+import numpy as np
+import yaml
+import synthetic
+
+etf = imp.load_source('etf_backtest', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'etf-backtest.py'))
+
+# Screener -> weights it is benchmarked with.
+SCREENER_ARGS = [
+    (etf.return_vol_screen, (0.4, 0.3, 0, 0.3)),
+    (etf.return_vol_ranked_screen, (.18, .72, 0, .1)),
+    (etf.sharpe_screen, (0.2, 0.2, 0.2, 0.2, 0.2)),
+    (etf.sharpe_screen2, ()),
+]
+
+
+@contextmanager
+def quiet():
+    """
+    Silences the pipeline's progress output.
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def timed(timings, name, f, *args, **kwargs):
+    t = time.time()
+    with quiet():
+        result = f(*args, **kwargs)
+    timings[name] = round(time.time() - t, 6)
+    return result
+
+
+def run(db, symbols, years, seed, repeat):
+    """
+    Builds db from synthetic data for symbols over years, ending at
+    etf.END_DATE, and returns the timings of every stage, screener and
+    backtest.
+    """
+    end_date = etf.END_DATE
+    start_date = str(datetime.date(*map(int, end_date.split('-'))) - datetime.timedelta(int(years * 365.25)))
+    syms = synthetic.synthetic_symbols(symbols)
+    fd, symbols_filename = tempfile.mkstemp(suffix='.yml')
+    with os.fdopen(fd, 'w') as f:
+        yaml.safe_dump({'synthetic': dict((sym, 'Synthetic ' + sym) for sym in syms)}, f)
+
+    stages, screeners, backtests = {}, {}, {}
+    if os.path.exists(db):
+        os.remove(db)
+    try:
+        with sqlite3.connect(db, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES) as c:
+            etf.apply_pragmas(c, 'build')
+            timed(stages, 'create_source_tables', etf.create_source_tables, c)
+            timed(stages, 'insert_symbols', etf.insert_symbols, c, symbols_filename)
+            timed(stages, 'insert_quotes', etf.insert_quotes, c, start_date, end_date, fetch=synthetic.synthetic_fetch(seed))
+            timed(stages, 'create_derived_tables', etf.create_derived_tables, c, defer_indexes=True)
+            for name in etf.required_indicators(*etf.INDICATORS):
+                timed(stages, etf.INDICATORS[name][0].__name__, etf.INDICATORS[name][0], c)
+            panel = timed(stages, 'PricePanel', etf.PricePanel, c)
+
+            month_ends = etf.month_ends(c)
+            for screener, args in SCREENER_ARGS:
+                runs = {}
+                for i in range(repeat):
+                    timed(runs, i, screener, panel, syms, month_ends[-2], month_ends[-1], args)
+                screeners[screener.__name__] = min(runs.values())
+                timed(backtests, screener.__name__, etf.backtest, panel, syms, screener, args)
+    finally:
+        os.remove(symbols_filename)
+
+    return {
+        'config': {
+            'symbols': symbols,
+            'years': years,
+            'seed': seed,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'numpy': np.__version__,
+        },
+        'stages': stages,
+        'screeners': screeners,
+        'backtests': backtests,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the etf-backtest pipeline on synthetic quotes.')
+    parser.add_argument('--symbols', type=int, default=8, help='number of symbols, SPY included')
+    parser.add_argument('--years', type=float, default=7.5, help='years of history ending at END_DATE')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='screener runs to take the best time of')
+    parser.add_argument('--db', default='benchmark.db', help='database to build; it is overwritten')
+    parser.add_argument('--output', help='file to write the JSON results to instead of stdout')
+    args = parser.parse_args()
+
+    results = run(args.db, args.symbols, args.years, args.seed, args.repeat)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(results, out, indent=2, sort_keys=True)
+    out.write('\n')
+    if args.output:
+        out.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+This is the "colstore" module.
+
+It stores tables as one .npy file per column, so readers can memory-map just
+the columns they need instead of materializing rows. Keys that repeat across
+tables, such as dates and symbols, are stored once as sorted index files and
+the tables hold int32 positions into them.
+
+Layout of a store directory:
+    <name>.npy            sorted index, e.g. dates.npy, symbols.npy
+    <table>/<column>.npy  one array per column, all of the same length
+
+sample usage:
+>>> import numpy as np, colstore
+>>> colstore.save_index('store', 'symbols', ['SPY', 'TLT'])
+>>> colstore.save('store', 'quote', {'sym': colstore.encode(['TLT'], colstore.load_index('store', 'symbols')),
+...                                  'adjClose': np.array([120.5])})
+>>> colstore.load('store', 'quote')['adjClose']
+memmap([ 120.5])
+"""
+
+import os
+import numpy as np
+
+
+def _save(path, a):
+    # Written to a temporary file and renamed so readers never map a partial file.
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, a)
+    os.rename(tmp_path, path)
+
+
+def save_index(directory, name, values):
+    """
+    Stores the sorted, distinct values as the index called name and returns
+    them as an array.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    index = np.unique(np.array(values, np.str_))
+    _save(os.path.join(directory, name + '.npy'), index)
+    return index
+
+
+def load_index(directory, name, mmap_mode='r'):
+    return np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+
+
+def encode(values, index):
+    """
+    Returns the int32 positions of values in the sorted index. Raises
+    ValueError if any value is not in the index.
+    """
+    values = np.asarray(values, np.str_) if index.dtype.kind == 'S' else np.asarray(values)
+    codes = np.searchsorted(index, values).astype(np.int32)
+    if len(values) and (codes.max() >= len(index) or (index[codes] != values).any()):
+        raise ValueError, "values missing from the index"
+    return codes
+
+
+def decode(codes, index):
+    return np.asarray(index)[codes]
+
+
+def save(directory, table, columns):
+    """
+    Stores columns, a dict of equally long 1-d arrays, as table. Columns of
+    the table that are not in columns are removed.
+    """
+    lengths = set(len(a) for a in columns.itervalues())
+    if len(lengths) > 1:
+        raise ValueError, "columns of {} differ in length".format(table)
+    table_dir = os.path.join(directory, table)
+    if not os.path.isdir(table_dir):
+        os.makedirs(table_dir)
+    for name in os.listdir(table_dir):
+        if name.endswith('.npy') and name[:-4] not in columns:
+            os.remove(os.path.join(table_dir, name))
+    for name, a in columns.iteritems():
+        _save(os.path.join(table_dir, name + '.npy'), np.ascontiguousarray(a))
+
+
+def load(directory, table, mmap_mode='r'):
+    """
+    Returns a dict of the columns of table. With the default mmap_mode the
+    arrays are read-only memory maps, so pages are read on first access and
+    shared between every process that maps the same store.
+    """
+    table_dir = os.path.join(directory, table)
+    return dict((name[:-4], np.load(os.path.join(table_dir, name), mmap_mode=mmap_mode))
+                for name in os.listdir(table_dir) if name.endswith('.npy'))
+
+
+def tables(directory):
+    """
+    Returns the names of the tables in the store.
+    """
+    return sorted(name for name in os.listdir(directory) if os.path.isdir(os.path.join(directory, name)))
@@ -1,45 +1,107 @@
 #!/usr/bin/env python
+import argparse
 import datetime
+import hashlib
+import os
 import sqlite3
 import sys
+import threading
+import time
+import uuid
+import cPickle
+import Queue
+import multiprocessing
 import ystockquote
+import quotecache
+import indicators
+import significance
+import colstore
+import instrument
+import synthetic
 from pprint import pprint
 import yaml
-from itertools import izip, islice, dropwhile
+from itertools import izip, dropwhile, repeat, groupby
 import numpy as np
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from functools import wraps
 from operator import itemgetter
 from math import floor
-import cProfile
+from bisect import bisect_right
+from StringIO import StringIO
 
 START_DATE = '2005-09-30'
 END_DATE = '2013-03-03'
 
+DB_FILENAME = 'prices.db'
+SYMBOLS_FILENAME = 'symbols.yml'
+DEFAULT_SYMS = 'DBC EFA SPY TLT VNQ BLV VWO BOND'.split()
+
+# (unit, unit_qty, days) of every period returns and volatilities are computed over.
+DURATIONS = [
+    ('day', 1, 1),
+    ('month', 1, 20),
+    ('quarter', 1, 63),
+]
+
+FETCH_WORKERS = 8
+FETCH_TIMEOUT = 30
+FETCH_ATTEMPTS = 3
+FETCH_BACKOFF = 1.0
+# Ticks per chunk handed from the download threads to the database.
+FETCH_CHUNK = 2000
+
+QUOTE_CACHE_DIR = '.quote_cache'
+QUOTE_CACHE_TTL = 24 * 60 * 60
+QUOTE_CACHE_BYTES = 256 * 1024 * 1024
+
+BULK_CHUNK = 50000
+
+COLUMN_STORE_DIR = 'columns'
+PROFILE_DIR = 'profiles'
+
+SCREEN_CACHE_SIZE = 4096
+SCREEN_CACHE_DB = '.screen_cache.db'
+
+PRAGMA_PROFILES = {
+    # SQLite's own defaults.
+    'default': {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'cache_size': -2000},
+    # No fsyncs and a 256MB page cache. A crash while it is in use can corrupt the whole file, quotes included, so
+    # it is only applied on request.
+    'build': {'journal_mode': 'MEMORY', 'synchronous': 'OFF', 'cache_size': -262144, 'temp_store': 'MEMORY'},
+}
+
+# Secondary indexes of the derived tables. The tables themselves are WITHOUT ROWID, clustered on their natural keys.
+DERIVED_INDEXES = {
+    'parabolic_sar': ['CREATE INDEX IF NOT EXISTS parabolic_sar_date ON parabolic_sar (dt)'],
+}
+
 def drop_source(c):
     drop(c, *'period duration quote symbol'.split())
 
 def drop_derived(c):
-    drop(c, *'return volatility ulcer_index parabolic_sar'.split())
+    drop(c, *'return volatility ulcer_index parabolic_sar parabolic_sar_state screen_metric watermark'.split())
     c.execute('DROP VIEW IF EXISTS daily_return')
 
 def drop_all(c):
     drop_derived(c)
     drop_source(c)
 
-def create_source_tables(c):
-    drop_all(c)
+@instrument.measure('stage')
+def create_source_tables(c, incremental=False):
+    if not incremental:
+        drop_all(c)
     
     print 'create source tables'
+    create_meta_table(c)
     c.execute('''
-CREATE TABLE symbol (
+CREATE TABLE IF NOT EXISTS symbol (
     sym_id INTEGER PRIMARY KEY,
     sym TEXT UNIQUE NOT NULL,
     description TEXT NOT NULL
 )''')
     c.execute('''
-CREATE TABLE quote (
-    quote_id INTEGER PRIMARY KEY,
-    sym_id INTEGER,
+CREATE TABLE IF NOT EXISTS quote (
+    sym_id INTEGER NOT NULL,
     dt DATE NOT NULL, 
     open REAL NOT NULL,
     high REAL NOT NULL,
@@ -47,48 +109,94 @@ CREATE TABLE quote (
     close REAL NOT NULL,
     volume REAL NOT NULL,
     adjClose REAL NOT NULL,
+    PRIMARY KEY (sym_id, dt),
     FOREIGN KEY(sym_id) REFERENCES symbol(sym_id)
-)''')
-    c.execute('CREATE UNIQUE INDEX quote_sym_dt ON quote (sym_id, dt)')
-    c.execute('CREATE UNIQUE INDEX quote_dt_sym ON quote(dt, sym_id)')
+) WITHOUT ROWID''')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS quote_dt_sym ON quote(dt, sym_id)')
     c.execute('''
-CREATE TABLE duration (
+CREATE TABLE IF NOT EXISTS duration (
     duration_id INTEGER PRIMARY KEY,
     unit TEXT NOT NULL,
     unit_qty INTEGER NOT NULL,
     days INTEGER UNIQUE NOT NULL
 )''')
-    c.execute('CREATE UNIQUE INDEX duration_unit_qty ON duration (unit, unit_qty)')
-    truncate(c, 'duration')
-    durations = [ \
-        ['day', 1, 1], \
-        ['month', 1, 20], \
-        ['quarter', 1, 63]]
-    c.executemany('INSERT INTO duration (unit, unit_qty, days) VALUES (?,?,?)', durations)
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS duration_unit_qty ON duration (unit, unit_qty)')
+    c.executemany('INSERT OR IGNORE INTO duration (unit, unit_qty, days) VALUES (?,?,?)', DURATIONS)
 
     c.execute('''
-CREATE TABLE period (
+CREATE TABLE IF NOT EXISTS period (
     period_id INTEGER PRIMARY KEY,
     duration_id INTEGER,
     start_dt DATE NOT NULL,
     end_dt DATE NOT NULL,
     FOREIGN KEY(duration_id) REFERENCES duration(duration_id)
 )''')
+    c.execute('CREATE INDEX IF NOT EXISTS period_end_dt ON period (end_dt)')
+    c.execute('CREATE INDEX IF NOT EXISTS period_duration_end_dt ON period (duration_id, end_dt)')
+
+def create_meta_table(c):
+    # meta is never dropped, so the data version keeps changing across rebuilds.
+    c.execute('''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+)''')
 
-def create_derived_tables(c):
+def get_meta(c, key):
+    rows = c.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchall()
+    return rows[0][0] if rows else None
+
+def set_meta(c, key, value):
+    c.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+    c.commit()
+
+def data_version(c):
+    '''returns the token identifying the current contents of quote and the derived tables'''
+    return get_meta(c, 'data_version')
+
+def bump_data_version(c):
+    set_meta(c, 'data_version', uuid.uuid4().hex)
+
+def changes_data(stage):
+    '''decorates a stage that writes symbols, quotes or derived tables so that it bumps the data version whenever it
+    changed any rows'''
+    @wraps(stage)
+    def run(c, *args, **kwargs):
+        before = c.total_changes
+        result = stage(c, *args, **kwargs)
+        if c.total_changes != before:
+            bump_data_version(c)
+        return result
+    return run
+
+@instrument.measure('stage')
+def create_derived_tables(c, defer_indexes=False, incremental=False):
+    '''With defer_indexes the derived tables are created bare and each compute_* stage indexes its table once it
+    has been loaded. With incremental the existing tables and their watermarks are kept, so the compute_* stages
+    only add rows for quotes that arrived since they last ran.'''
     print 'create derived tables'
-    drop_derived(c)
+    if not incremental:
+        drop_derived(c)
+        bump_data_version(c)
+
+    c.execute('''
+CREATE TABLE IF NOT EXISTS watermark (
+    sym_id INTEGER NOT NULL,
+    metric TEXT NOT NULL,
+    last_dt DATE NOT NULL,
+    PRIMARY KEY (sym_id, metric),
+    FOREIGN KEY(sym_id) REFERENCES symbol(sym_id)
+) WITHOUT ROWID''')
 
     c.execute('''
 CREATE TABLE IF NOT EXISTS return (
-    return_id INTEGER PRIMARY KEY,
-    sym_id INTEGER,
-    period_id INTEGER,
+    sym_id INTEGER NOT NULL,
+    period_id INTEGER NOT NULL,
     return REAL NOT NULL,
+    PRIMARY KEY (sym_id, period_id),
     FOREIGN KEY(sym_id) REFERENCES symbol(sym_id),
     FOREIGN KEY(period_id) REFERENCES period(period_id)
-)''')
-    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS return_sym_period ON return (sym_id, period_id)')
+) WITHOUT ROWID''')
 
     c.execute('''
 CREATE VIEW IF NOT EXISTS daily_return AS
@@ -98,287 +206,446 @@ WHERE d.days = 1''')
 
     c.execute('''
 CREATE TABLE IF NOT EXISTS volatility (
-    volatility_id INTEGER PRIMARY KEY,
-    sym_id INTEGER,
-    period_id INTEGER,
+    sym_id INTEGER NOT NULL,
+    period_id INTEGER NOT NULL,
     volatility REAL NOT NULL,
+    PRIMARY KEY (sym_id, period_id),
     FOREIGN KEY(sym_id) REFERENCES symbol(sym_id),
     FOREIGN KEY(period_id) REFERENCES period(period_id)
-)''')
-    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS volatility_sym_period ON volatility (sym_id, period_id)')
+) WITHOUT ROWID''')
 
     c.execute('''
 CREATE TABLE IF NOT EXISTS ulcer_index (
-    ulcer_index_id INTEGER PRIMARY KEY,
-    sym_id INTEGER,
-    period_id INTEGER,
+    sym_id INTEGER NOT NULL,
+    period_id INTEGER NOT NULL,
     ulcer_index REAL NOT NULL,
+    PRIMARY KEY (sym_id, period_id),
     FOREIGN KEY(sym_id) REFERENCES symbol(sym_id),
-    FOREIGN KEY(period_id) REFERENCES period(period_id)    
-)''')
-    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS ulcer_index_sym_period ON ulcer_index (sym_id, period_id)')
+    FOREIGN KEY(period_id) REFERENCES period(period_id)
+) WITHOUT ROWID''')
 
     c.execute('''
 CREATE TABLE IF NOT EXISTS parabolic_sar (
-    parabolic_sar_id INTEGER PRIMARY KEY,
-    sym_id INTEGER,
+    sym_id INTEGER NOT NULL,
     dt DATE NOT NULL,
     long_short CHAR(1) NOT NULL,
     parabolic_sar REAL NOT NULL,
+    PRIMARY KEY (sym_id, dt),
     FOREIGN KEY(sym_id) REFERENCES symbol(sym_id)
-)''')
-    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS parabolic_sar_sym_date ON parabolic_sar (sym_id, dt)')
-    c.execute('CREATE INDEX IF NOT EXISTS parabolic_sar_date ON parabolic_sar (dt)')
+) WITHOUT ROWID''')
 
-def insert_symbols(c, symbols_filename):
+    c.execute('''
+CREATE TABLE IF NOT EXISTS parabolic_sar_state (
+    sym_id INTEGER PRIMARY KEY,
+    dt DATE NOT NULL,
+    long_short CHAR(1) NOT NULL,
+    parabolic_sar REAL NOT NULL,
+    af REAL NOT NULL,
+    extreme_point REAL NOT NULL,
+    FOREIGN KEY(sym_id) REFERENCES symbol(sym_id)
+)''')
+    c.execute('''
+CREATE TABLE IF NOT EXISTS screen_metric (
+    end_dt DATE NOT NULL,
+    sym_id INTEGER NOT NULL,
+    month_return REAL NOT NULL,
+    quarter_return REAL NOT NULL,
+    month_volatility REAL NOT NULL,
+    quarter_volatility REAL NOT NULL,
+    PRIMARY KEY (end_dt, sym_id),
+    FOREIGN KEY(sym_id) REFERENCES symbol(sym_id)
+) WITHOUT ROWID''')
+
+    if not defer_indexes:
+        create_derived_indexes(c)
+
+def create_derived_indexes(c, *tables):
+    for table in tables or sorted(DERIVED_INDEXES):
+        for ddl in DERIVED_INDEXES.get(table, ()):
+            c.execute(ddl)
+
+@instrument.measure('stage')
+@changes_data
+def compute_screen_metrics(c):
+    '''Materializes the month and quarter returns and volatilities the screeners read into one row per end_dt and
+    symbol.'''
+    print 'compute screen metrics'
+    # CROSS JOIN fixes the join order: for each symbol walk its month periods and look the rest up by key. The unary +
+    # keeps SQLite from carrying the watermark range over to qp, which it would then search instead of end_dt.
+    c.execute('''
+INSERT INTO screen_metric (end_dt, sym_id, month_return, quarter_return, month_volatility, quarter_volatility)
+SELECT mp.end_dt, s.sym_id, mr.return, qr.return, mv.volatility, qv.volatility
+FROM symbol s
+     CROSS JOIN duration md
+     CROSS JOIN period mp
+     CROSS JOIN return mr
+     CROSS JOIN volatility mv
+     CROSS JOIN duration qd
+     CROSS JOIN period qp
+     CROSS JOIN return qr
+     CROSS JOIN volatility qv
+WHERE md.unit = 'month' AND
+      mp.duration_id = md.duration_id AND
+      mp.end_dt > COALESCE((SELECT last_dt FROM watermark w WHERE w.sym_id = s.sym_id AND w.metric = 'screen_metric'), '') AND
+      mr.sym_id = s.sym_id AND
+      mr.period_id = mp.period_id AND
+      mv.sym_id = s.sym_id AND
+      mv.period_id = mp.period_id AND
+      qd.unit = 'quarter' AND
+      qp.duration_id = qd.duration_id AND
+      qp.end_dt = +mp.end_dt AND
+      qr.sym_id = s.sym_id AND
+      qr.period_id = qp.period_id AND
+      qv.sym_id = s.sym_id AND
+      qv.period_id = qp.period_id''')
+    update_watermarks(c, 'screen_metric')
+    c.commit()
+
+def symbol_files(symbols_filename):
+    '''returns symbols_filename as a list of file names; it is either one name or a list of them'''
+    return [symbols_filename] if isinstance(symbols_filename, basestring) else list(symbols_filename)
+
+def load_symbol_files(symbols_filename):
+    '''returns file name -> category -> sym -> description for each symbols file, in order'''
+    sym_data = OrderedDict()
+    for filename in symbol_files(symbols_filename):
+        with open(filename) as sym_cfg:
+            sym_data[filename] = yaml.load(sym_cfg)
+    return sym_data
+
+@instrument.measure('stage')
+@changes_data
+def insert_symbols(c, symbols_filename, incremental=False):
+    '''Loads the symbols of one symbols file, or the union of the symbols of a list of them.'''
     print 'load symbols'
-    truncate(c, 'symbol')
-    with open(symbols_filename) as sym_cfg:
-        sym_data = yaml.load(sym_cfg)
-        syms = sorted((sym, desc) for cat in sym_data.itervalues() for sym, desc in cat.iteritems())
-    c.executemany('INSERT INTO symbol (sym, description) VALUES (?,?)', syms)
-
-def get_historical_prices(sym, start_date, end_date):
+    descriptions = {}
+    for sym_data in reversed(load_symbol_files(symbols_filename).values()):
+        descriptions.update((sym, desc) for cat in sym_data.itervalues() for sym, desc in cat.iteritems())
+    syms = sorted(descriptions.iteritems())
+    if incremental:
+        # Keep the existing sym_ids so stored quotes stay attached to their symbols.
+        c.executemany('INSERT OR IGNORE INTO symbol (sym, description) VALUES (?,?)', syms)
+    else:
+        truncate(c, 'symbol')
+        c.executemany('INSERT INTO symbol (sym, description) VALUES (?,?)', syms)
+
+def get_historical_prices(sym, start_date, end_date, timeout=FETCH_TIMEOUT, attempts=FETCH_ATTEMPTS, backoff=FETCH_BACKOFF,
+                          cache=None, chunk=FETCH_CHUNK):
+    '''Yields lists of at most chunk (sym, dt, open, high, low, close, volume, adjClose) ticks, typed, as they are
+    downloaded. A failed download is retried from its first day, so ticks already yielded can come again; quote
+    upserts them.'''
     print 'get quotes:', sym, start_date, end_date
-    attempt = 0
-    while True:
-        attempt += 1
-        if attempt >= 3:
-            raise IOError, "Unable to get data for " + sym + "."
+    for attempt in range(attempts):
         try:
-            ticks = ystockquote.get_historical_prices(sym, start_date, end_date)[1:]
+            ticks = []
+            for tick in ystockquote.iter_historical_prices(sym, start_date, end_date, timeout, cache):
+                ticks.append((sym,) + tick)
+                if len(ticks) == chunk:
+                    yield ticks
+                    ticks = []
+            if ticks:
+                yield ticks
         except IOError as e:
+            if attempt == attempts - 1:
+                raise IOError, "Unable to get data for " + sym + "."
+            # Exponential backoff: backoff, 2 * backoff, 4 * backoff, ...
+            time.sleep(backoff * 2 ** attempt)
             continue
         break
-        
-    return [[sym, datetime.datetime.strptime(tick[0], '%Y-%m-%d').date()] + tick[1:] for tick in ticks]
 
-def insert_quotes(c, start_date, end_date):
-    truncate(c, 'quote')
+def fetch_historical_prices(jobs, workers=FETCH_WORKERS, **kwargs):
+    '''Downloads (sym, start_date, end_date) jobs on at most workers threads and yields (sym, ticks) chunks as they
+    arrive, several per symbol for long histories. The chunks wait in a bounded queue, so memory use does not grow
+    with the length of the histories. Only the consuming thread should touch the database; the first failed download
+    is re-raised there.'''
+    jobs = list(jobs)
+    pending = Queue.Queue()
+    for job in jobs:
+        pending.put(job)
+    results = Queue.Queue(2 * workers)
+
+    def work():
+        while True:
+            try:
+                sym, start_date, end_date = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                for ticks in get_historical_prices(sym, start_date, end_date, **kwargs):
+                    results.put((sym, ticks, None))
+                # No ticks marks the end of the job.
+                results.put((sym, None, None))
+            except Exception:
+                results.put((sym, None, sys.exc_info()))
+
+    for i in range(min(workers, len(jobs))):
+        t = threading.Thread(target=work)
+        t.daemon = True
+        t.start()
+
+    try:
+        done = 0
+        while done < len(jobs):
+            sym, ticks, exc_info = results.get()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if ticks is None:
+                done += 1
+            else:
+                yield sym, ticks
+    finally:
+        # Stop handing out work if the consumer failed or stopped early.
+        while True:
+            try:
+                pending.get_nowait()
+            except Queue.Empty:
+                break
+
+def quote_watermarks(c):
+    '''returns a sym_id -> last stored quote dt dict'''
+    return dict_q(c, 'quote', 'sym_id', 'MAX(dt)', group_by='sym_id')
+
+@instrument.measure('stage')
+@changes_data
+def insert_quotes(c, start_date, end_date, incremental=False, workers=FETCH_WORKERS, cache=None, fetch=fetch_historical_prices):
+    '''Loads quotes for every symbol. In incremental mode only the days after each symbol's last stored quote are
+    downloaded and upserted; otherwise the quote table is rebuilt from scratch. fetch takes the (sym, start_date,
+    end_date) jobs and yields (sym, ticks) like fetch_historical_prices, which downloads them.'''
+    if incremental:
+        watermarks = quote_watermarks(c)
+    else:
+        truncate(c, 'quote')
+        watermarks = {}
     ksym_vid = dict_q(c, 'symbol', 'sym', 'sym_id')
+    jobs = []
     for sym, sym_id in ksym_vid.iteritems():
-        ticks = get_historical_prices(sym, start_date, end_date)
+        sym_start = max(start_date, next_day(watermarks[sym_id])) if sym_id in watermarks else start_date
+        if sym_start > end_date:
+            print 'quotes up to date:', sym
+            continue
+        jobs.append((sym, sym_start, end_date))
+    for sym, ticks in fetch(jobs, workers, cache=cache):
         c.executemany('''
 INSERT OR REPLACE INTO quote (sym_id, dt, open, high, low, close, volume, adjClose) VALUES (
 (SELECT sym_id FROM symbol WHERE sym = ?),?,?,?,?,?,?,?)''', ticks)
 
+@instrument.measure('stage')
+@changes_data
 def compute_periods(c):
+    '''Appends the periods that end on trading days after the last stored period of each duration.'''
     durations = c.execute('select duration_id, unit, unit_qty, days from duration').fetchall()
-    trading_days = col_query(c, 'select distinct dt from quote order by dt')
+    trading_days = map(str, col_query(c, 'select distinct dt from quote order by dt'))
     for duration_id, unit, unit_qty, days in durations:
         if len(trading_days) < days:
             raise ValueError, "not enough trading days to compute {} day periods".format(days)        
+        start = 0
+        last_end_dt = scalar_query(c, 'select max(end_dt) from period where duration_id = ?', duration_id)
+        if last_end_dt is not None:
+            start = bisect_right(trading_days, str(last_end_dt)) - days
+            if scalar_query(c, 'select count(*) from period where duration_id = ?', duration_id) != start:
+                raise ValueError, "trading days changed before the last {} day period; rebuild from scratch".format(days)
         print 'compute {} {} period: {} days'.format(unit_qty, unit, days)
-        for start_dt, end_dt in izip(trading_days, trading_days[days:]):
-            c.execute('INSERT INTO period (duration_id, start_dt, end_dt) VALUES (?,?,?)', (duration_id, start_dt, end_dt))
+        with BulkWriter(c, 'period', ('duration_id', 'start_dt', 'end_dt')) as w:
+            w.extend(izip(repeat(duration_id), trading_days[start:], trading_days[start + days:]))
 
+@instrument.measure('stage')
+@changes_data
 def compute_returns(c):
+    '''Computes the return of every period after each symbol's watermark. Prices are laid out on the trading day
+    calendar the periods are built on, so each duration's returns are one shift of a symbol's prices: a return
+    exists where the symbol was quoted on both the first and the last day of the period.'''
     print 'compute returns'
+    durations = c.execute('SELECT duration_id, days FROM duration ORDER BY days').fetchall()
+    trading_days = map(str, col_query(c, 'SELECT DISTINCT dt FROM quote ORDER BY dt'))
+    last_dts = watermarks(c, 'return')
+    min_last_dt = str(min_watermark(c, 'return'))
+    # Calendar positions from first on: the periods ending after min_last_dt and the days they start on.
+    first = max(bisect_right(trading_days, min_last_dt) - max(days for duration_id, days in durations), 0)
+    day_index = dict((dt, i) for i, dt in enumerate(trading_days[first:]))
+    period_ids = {}
+    for duration_id, days in durations:
+        period_ids[duration_id] = np.zeros(len(day_index), np.int)
+        for period_id, end_dt in c.execute('SELECT period_id, CAST(end_dt AS TEXT) FROM period WHERE duration_id = ? AND end_dt > ?',
+                                           (duration_id, min_last_dt)):
+            period_ids[duration_id][day_index[end_dt]] = period_id
+    with BulkWriter(c, 'return', ('sym_id', 'period_id', 'return')) as w:
+        for sym_id, rows in groupby(c.execute('SELECT sym_id, CAST(dt AS TEXT), adjClose FROM quote WHERE dt >= ? ORDER BY sym_id, dt',
+                                              (trading_days[first] if trading_days else '',)), itemgetter(0)):
+            _, dts, adj_close = izip(*rows)
+            prices = np.full(len(day_index), np.nan)
+            prices[[day_index[dt] for dt in dts]] = adj_close
+            # Positions of the periods that end after this symbol's watermark.
+            new = bisect_right(trading_days, str(last_dts.get(sym_id, ''))) - first
+            for duration_id, days in durations:
+                start = max(new, days)
+                start_prices, end_prices = prices[start - days:len(prices) - days], prices[start:]
+                returns = (end_prices - start_prices) / start_prices
+                valid = np.flatnonzero(~np.isnan(returns))
+                w.extend(izip(repeat(sym_id), period_ids[duration_id][start + valid].tolist(), returns[valid].tolist()))
+    update_watermarks(c, 'return')
+    c.commit()
+    create_derived_indexes(c, 'return')
+
+def update_watermarks(c, metric):
+    '''Records that metric has been computed through each symbol's last quote. Watermarks that have not moved are
+    left alone, so a run that found nothing new changes no rows.'''
     c.execute('''
-INSERT INTO return (sym_id, period_id, return)
-SELECT q1.sym_id, p.period_id, (q2.adjClose - q1.adjClose) / q1.adjClose
-FROM period p,
-    quote q1,
-    quote q2
-WHERE
-    p.start_dt = q1.dt AND
-    p.end_dt = q2.dt AND
-    q1.sym_id = q2.sym_id''')
-
-class VolatilityHelper:
-    def __init__(self):
-        pass
-    def returns(self, g):
-        '''returns a generator of returns. after consuming from this, you can see the last dt in self.last_dt'''
-        for dt, ret in g:
-            self.last_dt = dt
-            yield ret
-
+INSERT OR REPLACE INTO watermark (sym_id, metric, last_dt)
+SELECT q.sym_id, ?, MAX(q.dt) FROM quote q GROUP BY q.sym_id
+HAVING MAX(q.dt) IS NOT (SELECT w.last_dt FROM watermark w WHERE w.sym_id = q.sym_id AND w.metric = ?)''', (metric, metric))
+
+def watermarks(c, metric):
+    '''returns a sym_id -> last computed dt dict for metric'''
+    return dict(c.execute('SELECT sym_id, last_dt FROM watermark WHERE metric = ?', (metric,)).fetchall())
+
+def min_watermark(c, metric):
+    '''returns the earliest watermark of metric over the symbols with quotes, or '' if one of them has none'''
+    return scalar_query(c, '''
+SELECT CASE WHEN COUNT(w.last_dt) = COUNT(*) THEN MIN(w.last_dt) ELSE '' END
+FROM symbol s LEFT JOIN watermark w ON w.sym_id = s.sym_id AND w.metric = ?
+WHERE EXISTS (SELECT 1 FROM quote q WHERE q.sym_id = s.sym_id)''', metric) or ''
+
+@instrument.measure('stage')
+@changes_data
 def compute_volatility(c):
-    vh = VolatilityHelper()
+    w = BulkWriter(c, 'volatility', ('sym_id', 'period_id', 'volatility'))
+    last_dts = watermarks(c, 'volatility')
+    day_id = scalar_query(c, 'SELECT duration_id FROM duration WHERE days = 1')
     for duration_id, unit, unit_qty, days in c.execute('select duration_id, unit, unit_qty, days from duration where days <> 1').fetchall():
-        periods = {end_dt: period_id for period_id, end_dt in c.execute('select period_id, end_dt from period where duration_id = ?', (duration_id,))}
+        periods = {end_dt: period_id for period_id, end_dt in c.execute('select period_id, end_dt from period where duration_id = ? and end_dt > ?', (duration_id, min_watermark(c, 'volatility')))}
         for sym_id, sym in dict_q(c, 'symbol', 'sym_id', 'sym').iteritems():
             print '{} day volatility for {}'.format(days, sym)
+            # The daily returns after the watermark, plus the days before them that the first new window needs. Both
+            # walk the day periods through period_duration_end_dt and look each return up by primary key; the CROSS
+            # JOINs keep SQLite from scanning all of the symbol's returns instead.
             dt_dr = c.execute("""
-SELECT p.end_dt, r.return from
- return r, period p, duration d
-WHERE r.sym_id = ? AND
-      r.period_id = p.period_id AND
-      p.duration_id = d.duration_id AND
-      d.days = 1""", (sym_id,)).fetchall()
-            for start, end in enumerate(range(days+1, len(dt_dr)+1)):
-                ret = np.fromiter(vh.returns(islice(dt_dr, start, end)), np.float)
-                vol = ret.std() * 254 ** 0.5
-                c.execute('INSERT INTO volatility (sym_id, period_id, volatility) VALUES (?,?,?)', (sym_id, periods[vh.last_dt], vol))
-
+SELECT p.end_dt, r.return
+FROM period p CROSS JOIN return r
+WHERE p.duration_id = ? AND r.sym_id = ? AND r.period_id = p.period_id AND
+      p.end_dt >= COALESCE((SELECT p.end_dt FROM period p CROSS JOIN return r
+                            WHERE p.duration_id = ? AND r.sym_id = ? AND r.period_id = p.period_id AND p.end_dt <= ?
+                            ORDER BY p.end_dt DESC LIMIT 1 OFFSET ?), '')
+ORDER BY p.end_dt""", (day_id, sym_id, day_id, sym_id, last_dts.get(sym_id), days - 1)).fetchall()
+            if len(dt_dr) <= days:
+                continue
+            dts, rets = zip(*dt_dr)
+            # Each window holds days + 1 daily returns and is stored against the end_dt of its last return.
+            vols = indicators.rolling_std(np.array(rets, np.float), days + 1) * 254 ** 0.5
+            w.extend(izip(repeat(sym_id), (periods[dt] for dt in dts[days:]), vols.tolist()))
+    update_watermarks(c, 'volatility')
+    w.close()
+    create_derived_indexes(c, 'volatility')
+
+@instrument.measure('stage')
+@changes_data
 def compute_ulcer_index(c):
+    w = BulkWriter(c, 'ulcer_index', ('sym_id', 'period_id', 'ulcer_index'))
+    last_dts = watermarks(c, 'ulcer_index')
     for duration_id, unit, unit_qty, days in c.execute('select duration_id, unit, unit_qty, days from duration where days <> 1').fetchall():
-        periods = {end_dt: period_id for period_id, end_dt in c.execute('select period_id, end_dt from period where duration_id = ?', (duration_id,))}
+        periods = {end_dt: period_id for period_id, end_dt in c.execute('select period_id, end_dt from period where duration_id = ? and end_dt > ?', (duration_id, min_watermark(c, 'ulcer_index')))}
         for sym_id, sym in c.execute('select sym_id, sym from symbol').fetchall():
             print '{} day ulcer index for {}'.format(days, sym)
-            dt_quote = c.execute('select dt, adjClose from quote natural join symbol where sym = ? order by dt asc', (sym,)).fetchall()
-            for start, end in enumerate(range(days+1, len(dt_quote)+1)):
-                mx = None
-                ssq = 0
-                for dt, p in islice(dt_quote, start, end):
-                    mx = max(mx, p)
-                    ssq += (100 * (p - mx) / mx) ** 2
-                ui = (ssq / days) ** 0.5
-                c.execute('INSERT INTO ulcer_index (sym_id, period_id, ulcer_index) VALUES (?,?,?)', (sym_id, periods[dt], ui))
-
-class HighLow:
-    def __init__(self, dt, high, low):
-        self.dt = dt
-        self.high = high
-        self.low = low
-
-    def __repr__(self):
-        return 'HighLow[{}, {}, {}]'.format(self.dt, self.high, self.low)
-
-def is_hip(d1, d2, d3):
-    return d1.high < d2.high and d2.high > d3.high
-
-def is_lop(d1, d2, d3):
-    return d1.low > d2.low and d2.low < d3.low
-
-def sip(d1, d2, d3):
-    hip, lop = is_hip(d1, d2, d3), is_lop(d1, d2, d3)
-    if hip and lop:
-        return None, None
-    elif hip:
-        return d2, None
-    elif lop:
-        return None, d2
-    else:
-        return None, None
-
+            # The prices after the watermark, plus the days before them that the first new window needs.
+            dt_quote = c.execute('''
+SELECT dt, adjClose FROM quote
+WHERE sym_id = ? AND
+      dt >= COALESCE((SELECT dt FROM quote WHERE sym_id = ? AND dt <= ? ORDER BY dt DESC LIMIT 1 OFFSET ?), '')
+ORDER BY dt''', (sym_id, sym_id, last_dts.get(sym_id), days - 1)).fetchall()
+            if len(dt_quote) <= days:
+                continue
+            dts, prices = zip(*dt_quote)
+            # Windows hold days + 1 prices but, as always, the squared drawdowns are averaged over days.
+            uis = indicators.rolling_ulcer_index(np.array(prices, np.float), days + 1, days)
+            w.extend(izip(repeat(sym_id), (periods[dt] for dt in dts[days:]), uis.tolist()))
+    update_watermarks(c, 'ulcer_index')
+    w.close()
+    create_derived_indexes(c, 'ulcer_index')
+
+@instrument.measure('stage')
+@changes_data
 def compute_parabolic_sar(c):
-    for sym_id, sym in dict_q(c, 'symbol', 'sym_id', 'sym').iteritems():
-        print 'computing parabolic sar for', sym
-        dhl = [HighLow(*r) for r in c.execute('SELECT dt, high, low FROM quote WHERE quote.sym_id = ? ORDER BY dt ASC', (sym_id,)).fetchall()]
-        d1, d2, d3 = dhl[0:3]
-
-        # Find first high or low significant points to determine whether to initiate an initial short or long position.
-        for i, d4 in enumerate(islice(dhl, 3, None), start=1):
-            hip, lop = sip(d1, d2, d3)
-            d1, d2, d3  = d2, d3, d4
-            if hip or lop:
-                #print hip, lop
-                first_sigp_i = i
-                break
-
-        # For the first day of entry, SAR is the previous significant point. If long, the LOP, if short, the HIP.
-        if lop:
-            position = 'L'
-            max_p = d2.high
-            sar = lop.low
-        else:
-            position = 'S'
-            min_p = d2.low
-            sar = hip.high
-        af = 0.02
-
-        for d4 in islice(dhl, first_sigp_i + 3, None):
-            #print '{} | {:<5} | {:>6.2f} | {:>6.2f} | {:>6.2f} |'.format(d2.dt, position, d2.high, d2.low, sar),
-            c.execute('INSERT INTO parabolic_sar (sym_id, dt, long_short, parabolic_sar) VALUES (?,?,?,?)', (sym_id, d2.dt, position, sar))
-            
-            if position == 'L':
-                if sar > d2.low:
-                    # reversal
-                    position = 'S'
-                    af = 0.02
-                    min_p = d2.low
-                    diff = 0
-                    af_diff = 0
-                    #print '{:>6.2f} | {:>6.2f} | {:>1.2f} | {:>2.2f} |'.format(min_p, diff, af, af_diff)
-                    sar = max_p
-                else:
-                    if d2.high > max_p:
-                        max_p = d2.high
-                        new_ep = 1
-                    else:
-                        new_ep = 0
-                    #print '{:>6.2f} |'.format(max_p),
-
-                    diff = max_p - sar
-                    af_diff = af * diff
-                    #print '{:>6.2f} | {:>1.2f} | {:>2.2f} |'.format(diff, af, af_diff)
-
-                    if new_ep:
-                        af = min(af + 0.02, 0.2)
-                    
-                    sar += af_diff
-
-                    if sar > d1.low or sar > d2.low:
-                        sar = min(d1.low, d2.low)
-            else:
-                if sar < d2.high:
-                    # reversal
-                    position = 'L'
-                    af = 0.02
-                    max_p = d2.high
-                    diff = 0
-                    af_diff = 0
-                    #print '{:>6.2f} | {:>6.2f} | {:>1.2f} | {:>2.2f} |'.format(max_p, diff, af, af_diff)
-                    sar = min_p
-                else:
-                    if d2.low < min_p:
-                        min_p = d2.low
-                        new_ep = 1
-                    else:
-                        new_ep = 0
-                    #print '{:>6.2f} |'.format(min_p),
-
-                    diff = sar - min_p
-                    af_diff = af * diff
-                    #print '{:>6.2f} | {:>1.2f} | {:>2.2f} |'.format(diff, af, af_diff)
-
-                    if new_ep:
-                        af = min(af + 0.02, 0.2)
-
-                    sar -= af_diff
-
-                    if sar < d1.high or sar < d2.high:
-                        sar = max(d1.high, d2.high)
-
-            d1, d2, d3 = d2, d3, d4
-
+    states = dict((r[0], r[1:]) for r in c.execute('SELECT sym_id, dt, long_short, parabolic_sar, af, extreme_point FROM parabolic_sar_state'))
+    # Each symbol's bars start at its saved state, or at its first quote if it has none.
+    sym_ids, dts, highs, lows = [], [], [], []
+    for sym_id, rows in groupby(c.execute('''
+SELECT q.sym_id, q.dt, q.high, q.low
+FROM quote q LEFT JOIN parabolic_sar_state s ON s.sym_id = q.sym_id
+WHERE q.dt >= COALESCE(s.dt, '')
+ORDER BY q.sym_id, q.dt'''), itemgetter(0)):
+        _, dt, high, low = izip(*rows)
+        sym_ids.append(sym_id)
+        dts.append(dt)
+        highs.append(np.array(high))
+        lows.append(np.array(low))
+    print 'computing parabolic sar for', len(sym_ids), 'symbols'
+
+    saved = [states.get(sym_id, (None, 'L', 0., 0., 0.)) for sym_id in sym_ids]
+    resumed = [sym_id in states for sym_id in sym_ids]
+    state = (np.array(resumed),
+             np.array([indicators.LONG if s[1] == 'L' else indicators.SHORT for s in saved]),
+             np.array([s[2] for s in saved]),
+             np.array([s[3] for s in saved]),
+             np.array([s[4] for s in saved]))
+    symbol, bar, position, sar, state = indicators.parabolic_sar(highs, lows, state)
+
+    long_short = {indicators.LONG: 'L', indicators.SHORT: 'S'}
+    with BulkWriter(c, 'parabolic_sar', ('sym_id', 'dt', 'long_short', 'parabolic_sar')) as w:
+        w.extend((sym_ids[k], dts[k][t], long_short[p], v) for k, t, p, v in izip(symbol.tolist(), bar.tolist(), position.tolist(), sar.tolist()))
+        # A resumed symbol still at bar 0 had no new bars, so its saved state is unchanged.
+        c.executemany('INSERT OR REPLACE INTO parabolic_sar_state (sym_id, dt, long_short, parabolic_sar, af, extreme_point) VALUES (?,?,?,?,?,?)',
+                      ((sym_ids[k], dts[k][t], long_short[p], v, af, ep)
+                       for k, (opened, t, p, v, af, ep) in enumerate(izip(*[a.tolist() for a in state])) if opened and (t or not resumed[k])))
+    create_derived_indexes(c, 'parabolic_sar')
+
+# Derived table -> (function that computes it, derived tables it reads). All of them read the quote table.
+INDICATORS = {
+    'period': (compute_periods, ()),
+    'return': (compute_returns, ('period',)),
+    'volatility': (compute_volatility, ('return',)),
+    'screen_metric': (compute_screen_metrics, ('return', 'volatility')),
+    'ulcer_index': (compute_ulcer_index, ('period',)),
+    'parabolic_sar': (compute_parabolic_sar, ()),
+}
+
+def required_indicators(*names):
+    '''returns names and every indicator they depend on, each after its dependencies'''
+    ordered = []
+    def visit(name):
+        if name not in ordered:
+            for dep in INDICATORS[name][1]:
+                visit(dep)
+            ordered.append(name)
+    for name in names:
+        visit(name)
+    return ordered
+
+def return_vol_metrics(c, syms, end_dt):
+    '''returns (sym, quarter return, month return, month volatility, quarter volatility) rows for end_dt'''
+    params = '?,' * (len(syms) - 1) + '?'
+    return c.execute('''
+SELECT s.sym, m.quarter_return, m.month_return, m.month_volatility, m.quarter_volatility
+FROM screen_metric m NATURAL JOIN symbol s
+WHERE m.end_dt = ? AND
+      s.sym IN ({})
+ORDER BY s.sym'''.format(params), (end_dt,) + tuple(syms)).fetchall()
+
+def sharpe_metrics(c, syms, end_dt):
+    '''returns (sym, quarter return, month return, quarter sharpe, month sharpe, month sharpe - quarter sharpe / 3) rows
+    for end_dt'''
+    params = '?,' * (len(syms) - 1) + '?'
+    return c.execute('''
+SELECT s.sym, m.quarter_return, m.month_return,
+       m.quarter_return / m.quarter_volatility, m.month_return / m.month_volatility,
+       (m.month_return / m.month_volatility) - (m.quarter_return / 3 / m.quarter_volatility)
+FROM screen_metric m NATURAL JOIN symbol s
+WHERE m.end_dt = ? AND
+      s.sym IN ({})
+ORDER BY s.sym'''.format(params), (end_dt,) + tuple(syms)).fetchall()
+
+@instrument.measure('screener')
 def return_vol_screen(c, syms, start_dt, end_dt, weights):
     assert abs(sum(weights) - 1) < 0.001
-    params = '?,' * (len(syms) - 1) + '?'
-    raw_results = c.execute('''
-SELECT s.sym, t0.return0, t1.return1, t2.volatility0, t3.volatility1
-FROM
-(SELECT r0.sym_id AS sym_id, r0.return AS return0 FROM
-    return r0
-    NATURAL JOIN period r0p
-    NATURAL JOIN duration r0d
- WHERE r0d.unit = 'quarter' AND
-       r0p.end_dt = ?) AS t0
- NATURAL JOIN
-(SELECT r1.sym_id AS sym_id, r1.return AS return1 FROM
-    return r1
-    NATURAL JOIN period r1p
-    NATURAL JOIN duration r1d
- WHERE r1d.unit = 'month' AND
-       r1p.end_dt = ?) AS t1
- NATURAL JOIN
- (SELECT v0.sym_id AS sym_id, v0.volatility AS volatility0 FROM
-    volatility v0
-    NATURAL JOIN period v0p
-    NATURAL JOIN duration v0d
- WHERE v0d.unit = 'month' AND
-       v0p.end_dt = ?) AS t2
- NATURAL JOIN
- (SELECT v1.sym_id AS sym_id, v1.volatility AS volatility1 FROM
-    volatility v1
-    NATURAL JOIN period v1p
-    NATURAL JOIN duration v1d
- WHERE v1d.unit = 'quarter' AND
-       v1p.end_dt = ?) AS t3
- NATURAL JOIN symbol s
- WHERE s.sym IN ({})'''.format(params), (end_dt,) * 4 + tuple(syms)).fetchall()
+    raw_results = return_vol_metrics(c, syms, end_dt)
 
     scores = defaultdict(float)
     for i in range(1,5):
@@ -386,45 +653,14 @@ FROM
         sym_score = sorted(map(itemgetter(0,i), raw_results), key=itemgetter(1), reverse=rev)
         for sym, score in sym_score:
             scores[sym] += weights[i-1] * score
-    final_ranked = sorted(scores.items(), key=itemgetter(1))
+    final_ranked = sorted(scores.items(), key=lambda kv: (kv[1], kv[0]))
     ksym_vdata = dict((r[0], r[1:]) for r in raw_results)
     return [(i, sym) + ksym_vdata[sym] for i, (sym, score) in enumerate(final_ranked)]
 
+@instrument.measure('screener')
 def return_vol_ranked_screen(c, syms, start_dt, end_dt, weights):
     #assert abs(sum(weights) - 1) < 0.001
-    params = '?,' * (len(syms) - 1) + '?'
-    raw_results = c.execute('''
-SELECT s.sym, t0.return0, t1.return1, t2.volatility0, t3.volatility1
-FROM
-(SELECT r0.sym_id AS sym_id, r0.return AS return0 FROM
-    return r0
-    NATURAL JOIN period r0p
-    NATURAL JOIN duration r0d
- WHERE r0d.unit = 'quarter' AND
-       r0p.end_dt = ?) AS t0
- NATURAL JOIN
-(SELECT r1.sym_id AS sym_id, r1.return AS return1 FROM
-    return r1
-    NATURAL JOIN period r1p
-    NATURAL JOIN duration r1d
- WHERE r1d.unit = 'month' AND
-       r1p.end_dt = ?) AS t1
- NATURAL JOIN
- (SELECT v0.sym_id AS sym_id, v0.volatility AS volatility0 FROM
-    volatility v0
-    NATURAL JOIN period v0p
-    NATURAL JOIN duration v0d
- WHERE v0d.unit = 'month' AND
-       v0p.end_dt = ?) AS t2
- NATURAL JOIN
- (SELECT v1.sym_id AS sym_id, v1.volatility AS volatility1 FROM
-    volatility v1
-    NATURAL JOIN period v1p
-    NATURAL JOIN duration v1d
- WHERE v1d.unit = 'quarter' AND
-       v1p.end_dt = ?) AS t3
- NATURAL JOIN symbol s
- WHERE s.sym IN ({})'''.format(params), (end_dt,) * 4 + tuple(syms)).fetchall()
+    raw_results = return_vol_metrics(c, syms, end_dt)
 
     scores = defaultdict(float)
     for i in range(1,5):
@@ -432,57 +668,32 @@ FROM
         ranked = sorted(map(itemgetter(0,i), raw_results), key=itemgetter(1), reverse=rev)
         for rank, (sym, score) in enumerate(ranked):
             scores[sym] += weights[i-1] * rank
-    final_ranked = sorted(scores.items(), key=itemgetter(1))
+    final_ranked = sorted(scores.items(), key=lambda kv: (kv[1], kv[0]))
     ksym_vdata = dict((r[0], r[1:]) for r in raw_results)
     return [(i, sym) + ksym_vdata[sym] for i, (sym, score) in enumerate(final_ranked)]
 
+@instrument.measure('screener')
 def sharpe_screen(c, syms, start_dt, end_dt, weights):
     assert abs(sum(weights) - 1) < 0.001
-    params = '?,' * (len(syms) - 1) + '?'
-    raw_results = c.execute('''
-SELECT s.sym, t0.return0, t1.return1,
-       t0.return0 / t2.volatility0, t1.return1 / t3.volatility1,
-       (t1.return1 / t3.volatility1) - (t0.return0 / 3 / t2.volatility0)
-FROM
-(SELECT r0.sym_id AS sym_id, r0.return AS return0 FROM
-    return r0
-    NATURAL JOIN period r0p
-    NATURAL JOIN duration r0d
- WHERE r0d.unit = 'quarter' AND
-       r0p.end_dt = ?) AS t0
- NATURAL JOIN
-(SELECT r1.sym_id AS sym_id, r1.return AS return1 FROM
-    return r1
-    NATURAL JOIN period r1p
-    NATURAL JOIN duration r1d
- WHERE r1d.unit = 'month' AND
-       r1p.end_dt = ?) AS t1
- NATURAL JOIN
- (SELECT v0.sym_id AS sym_id, v0.volatility AS volatility0 FROM
-    volatility v0
-    NATURAL JOIN period v0p
-    NATURAL JOIN duration v0d
- WHERE v0d.unit = 'quarter' AND
-       v0p.end_dt = ?) AS t2
- NATURAL JOIN
- (SELECT v1.sym_id AS sym_id, v1.volatility AS volatility1 FROM
-    volatility v1
-    NATURAL JOIN period v1p
-    NATURAL JOIN duration v1d
- WHERE v1d.unit = 'month' AND
-       v1p.end_dt = ?) AS t3
- NATURAL JOIN symbol s
- WHERE s.sym IN ({})'''.format(params), (end_dt,) * 4 + tuple(syms)).fetchall()
+    raw_results = sharpe_metrics(c, syms, end_dt)
 
     scores = defaultdict(float)
     for i in range(1,6):
         ranked = sorted(map(itemgetter(0,i), raw_results), key=itemgetter(1), reverse=True)
         for rank, (sym, score) in enumerate(ranked):
             scores[sym] += weights[i-1] * rank
-    final_ranked = sorted(scores.items(), key=itemgetter(1))
+    final_ranked = sorted(scores.items(), key=lambda kv: (kv[1], kv[0]))
     ksym_vdata = dict((r[0], r[1:]) for r in raw_results)
     return [(i, sym) + ksym_vdata[sym] for i, (sym, score) in enumerate(final_ranked)]
 
+# Screener -> (metrics query, how weights combine the metrics, which metrics rank in descending order), used by sweep.
+SWEEP_SCORING = {
+    return_vol_screen: (return_vol_metrics, 'value', (True, True, False, False)),
+    return_vol_ranked_screen: (return_vol_metrics, 'rank', (True, True, False, False)),
+    sharpe_screen: (sharpe_metrics, 'rank', (True,) * 5),
+}
+
+@instrument.measure('screener')
 def sharpe_screen2(c, syms, start_dt, end_dt, weights):
     sym_to_returns = {sym: daily_returns(c, sym, start_dt, end_dt) for sym in syms}
     sym_to_returns = {sym: returns for sym, returns in sym_to_returns.iteritems() if len(returns) > 1}
@@ -490,18 +701,34 @@ def sharpe_screen2(c, syms, start_dt, end_dt, weights):
     sorted_by_sharpe = sorted(sym_to_sharpe.items(), key=itemgetter(1), reverse=True)
     return [(i, sym, sharpe) for i, (sym, sharpe) in enumerate(sorted_by_sharpe)]
 
-def backtest(c, syms, screener, screener_args, start_cash=50000.00):
+# Screener -> derived tables it reads, directly or through its metrics query.
+SCREENER_INDICATORS = {
+    return_vol_screen: ('screen_metric',),
+    return_vol_ranked_screen: ('screen_metric',),
+    sharpe_screen: ('screen_metric',),
+    sharpe_screen2: ('return',),
+}
+
+@instrument.measure('backtest')
+def backtest(c, syms, screener, screener_args, start_cash=50000.00, cache=None):
     assert start_cash > 0
+    version = data_version(c) if cache else None
+    def screen(start_dt, end_dt):
+        if cache:
+            return cache.call(screener, c, syms, start_dt, end_dt, screener_args, version=version)
+        return screener(c, syms, start_dt, end_dt, screener_args)
+
     cash = start_cash
     spy_cash = start_cash
 
     returns = []
     spy_returns = []
+    periods = []
 
     sym = None
     last_d = scalar_query(c, "SELECT MIN(dt) FROM quote")
     for d in dropwhile(lambda dt: dt <= last_d, month_ends(c)):
-        scr_res = screener(c, syms, last_d, d, screener_args)
+        scr_res = screen(last_d, d)
         if not scr_res:
             continue
 
@@ -513,6 +740,7 @@ def backtest(c, syms, screener, screener_args, start_cash=50000.00):
             pnl = exit_amt - enter_amt
             pnl_pct = (exit_prc - enter_prc) / enter_prc
             returns.append(pnl_pct)
+            periods.append((last_d, d))
             cash += exit_amt
 
             # Sell SPY
@@ -559,7 +787,7 @@ def backtest(c, syms, screener, screener_args, start_cash=50000.00):
     spy_cash += exit_spy_amt
 
     # Print next screen
-    print '\n'.join(map(str, screener(c, syms, last_d, d, screener_args)))
+    print '\n'.join(map(str, screen(last_d, d)))
 
     # Print total performance
     tot_return = (cash - start_cash) / start_cash
@@ -572,10 +800,695 @@ def backtest(c, syms, screener, screener_args, start_cash=50000.00):
         print '{:>10}: {:6.2%}'.format(f, v)
     for f, v in zip(('Sharpe Ratio', 'SPY Sharpe Ratio'), (tot_sharpe, spy_sharpe)):
         print '{:>10}: {:6.2f}'.format(f, v)
+    return OrderedDict([
+        ('return', tot_return),
+        ('spy_return', spy_tot_return),
+        ('vol', tot_vol),
+        ('spy_vol', spy_vol),
+        ('sharpe', tot_sharpe),
+        ('spy_sharpe', spy_sharpe),
+        ('returns', returns),
+        ('spy_returns', spy_returns),
+        ('periods', periods),
+    ])
+
+def period_returns(c, syms, periods):
+    '''returns the (period, symbol) array of the return of each of syms over each (start, end) period in periods,
+    NaN where a symbol was not quoted on both days'''
+    panel = c if isinstance(c, PricePanel) else PricePanel(c)
+    cols = [panel.sym_index.get(sym) for sym in syms]
+    prices = np.full((len(periods), len(syms), 2), np.nan)
+    for k, dts in enumerate(zip(*periods)):
+        rows = panel.adj_close[[panel.date_index[str(dt)] for dt in dts]]
+        for j, col in enumerate(cols):
+            if col is not None:
+                prices[:, j, k] = rows[:, col]
+    return (prices[:, :, 1] - prices[:, :, 0]) / prices[:, :, 0]
+
+def sweep_inputs(c, syms, screener, cache=None):
+    '''Loads everything a weight sweep of screener needs, none of which depends on the weights: the backtest's month
+    ends, the screen metrics per (month, symbol) with NaN where a symbol was not screened, and the adjClose of every
+    symbol and of SPY at each month end. With a cache, the metrics of each month are looked up there first. The
+    symbols are put in sym order, the order the screeners break ties in.'''
+    metrics_query, kind, reverse = SWEEP_SCORING[screener]
+    syms = sorted(set(syms))
+    panel = c if isinstance(c, PricePanel) else PricePanel(c)
+    first_d = scalar_query(c, "SELECT MIN(dt) FROM quote")
+    dates = list(dropwhile(lambda dt: dt <= first_d, month_ends(c)))
+    sym_index = dict((sym, i) for i, sym in enumerate(syms))
+    metrics = np.full((len(dates), len(syms), len(reverse)), np.nan)
+    version = data_version(c) if cache else None
+    for m, d in enumerate(dates):
+        for row in cache.call(metrics_query, c, syms, d, version=version) if cache else metrics_query(c, syms, d):
+            metrics[m, sym_index[row[0]]] = [np.nan if v is None else v for v in row[1:]]
+    rows = [panel.date_index[str(d)] for d in dates]
+    return {
+        'syms': syms,
+        'dates': dates,
+        'metrics': metrics,
+        'prices': panel.adj_close[rows][:, [panel.sym_index[sym] for sym in syms]],
+        'spy_prices': panel.adj_close[rows, panel.sym_index['SPY']],
+    }
+
+def sweep_features(inputs, screener):
+    '''returns the (month, symbol, metric) array that screener's weights are applied to: the metric values for
+    return_vol_screen, or each symbol's position in that month's sort on the metric for the rank based screeners'''
+    metrics_query, kind, reverse = SWEEP_SCORING[screener]
+    metrics = inputs['metrics']
+    if kind == 'value':
+        return metrics
+    ranks = np.full(metrics.shape, np.nan)
+    for m in range(metrics.shape[0]):
+        valid = np.flatnonzero(~np.isnan(metrics[m, :, 0]))
+        for k, rev in enumerate(reverse):
+            values = metrics[m, :, k]
+            order = valid[np.argsort(-values[valid] if rev else values[valid], kind='mergesort')]
+            ranks[m, order, k] = np.arange(len(order))
+    return ranks
+
+def sweep_choices(features, weights):
+    '''Scores every symbol under every weight vector at once and returns the (month, config) index of the symbol
+    each config buys, or -1 where nothing was screened that month. Lower scores win, as in the screeners, and ties go
+    to the first symbol, which is the first in sym order as there. The scores are summed one metric at a time, in
+    the screeners' order, so that they tie exactly when the screeners' scores do.'''
+    choices = np.full((features.shape[0], len(weights)), -1, np.int)
+    for m in range(features.shape[0]):
+        valid = ~np.isnan(features[m, :, 0])
+        if not valid.any():
+            continue
+        scores = np.zeros((features.shape[1], len(weights)))
+        for k in range(features.shape[2]):
+            scores += np.nan_to_num(features[m, :, k])[:, None] * weights[:, k]
+        scores[~valid] = np.inf
+        choices[m] = scores.argmin(axis=0)
+    return choices
+
+def simulate(prices, spy_prices, choices, start_cash=50000.00):
+    '''Replays backtest for every column of choices at once, with the same whole-share, cash-carrying arithmetic.
+    Returns the (month, config) returns of each holding period, SPY's returns and the final cash of each config.'''
+    active = np.flatnonzero(choices[:, 0] >= 0)
+    configs = np.arange(choices.shape[1])
+    cash = np.full(choices.shape[1], start_cash)
+    spy_cash = start_cash
+    returns = []
+    spy_returns = []
+    for n, m in enumerate(active):
+        if n:
+            exit_prc = prices[m, held]
+            returns.append((exit_prc - enter_prc) / enter_prc)
+            cash += shares * exit_prc
+            exit_spy_prc = spy_prices[m]
+            spy_returns.append((exit_spy_prc - enter_spy_prc) / enter_spy_prc)
+            spy_cash += spy_shares * exit_spy_prc
+        held = choices[m]
+        enter_prc = prices[m, held]
+        shares = cash // enter_prc
+        cash -= enter_prc * shares
+        enter_spy_prc = spy_prices[m]
+        spy_shares = spy_cash // enter_spy_prc
+        spy_cash -= enter_spy_prc * spy_shares
+    if len(active):
+        # backtest sells at the last month end, screened or not.
+        cash += shares * prices[-1, held]
+        spy_cash += spy_shares * spy_prices[-1]
+    return np.array(returns).reshape(-1, len(configs)), np.array(spy_returns), cash, spy_cash
+
+def performance(returns, cash, start_cash=50000.00):
+    '''returns total return, annualized vol and Sharpe ratio arrays, one per column of returns, as backtest
+    computes them'''
+    tot_return = (cash - start_cash) / start_cash
+    n = len(returns)
+    tot_vol = np.sqrt(np.square(returns - returns.mean(axis=0)).sum(axis=0) / max(n - 1, 1)) * 12 ** 0.5
+    return tot_return, tot_vol, returns.sum(axis=0) / n / tot_vol
+
+# Inputs of the sweep in progress. Pool workers are forked after this is set, so they read it without pickling.
+_sweep_state = {}
+
+def _sweep_chunk(bounds):
+    lo, hi = bounds
+    weights = _sweep_state['weights'][lo:hi]
+    choices = sweep_choices(_sweep_state['features'], weights)
+    inputs = _sweep_state['inputs']
+    returns, spy_returns, cash, spy_cash = simulate(inputs['prices'], inputs['spy_prices'], choices, _sweep_state['start_cash'])
+    return zip(*performance(returns, cash, _sweep_state['start_cash']))
+
+@instrument.measure('sweep')
+def sweep(c, syms, screener, weight_grid, start_cash=50000.00, processes=None, chunk=64, cache=None):
+    '''Backtests screener once per weight vector in weight_grid and returns [(weights, total return, vol, Sharpe)]
+    in grid order. The screen metrics and prices are loaded once, each month is scored for a whole chunk of weight
+    vectors with one matrix product, and the chunks are spread over a pool of processes.'''
+    weights = np.array(weight_grid, np.float)
+    if weights.ndim != 2 or weights.shape[1] != len(SWEEP_SCORING[screener][2]):
+        raise ValueError, "{} takes {} weights".format(screener.__name__, len(SWEEP_SCORING[screener][2]))
+    inputs = sweep_inputs(c, syms, screener, cache)
+    _sweep_state.update(inputs=inputs, features=sweep_features(inputs, screener), weights=weights, start_cash=start_cash)
+    bounds = [(lo, lo + chunk) for lo in range(0, len(weights), chunk)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = [r for rs in pool.map(_sweep_chunk, bounds) for r in rs]
+    finally:
+        pool.close()
+        pool.join()
+        _sweep_state.clear()
+    return [(tuple(w),) + tuple(map(float, r)) for w, r in izip(weight_grid, results)]
+
+def compositions(n, total):
+    '''yields every n-tuple of non-negative integers that sum to total'''
+    if n == 1:
+        yield (total,)
+        return
+    for i in range(total + 1):
+        for rest in compositions(n - 1, total - i):
+            yield (i,) + rest
+
+def simplex_grid(n, steps):
+    '''returns every n-tuple of weights that are multiples of 1 / steps and sum to 1'''
+    return [tuple(float(i) / steps for i in comp) for comp in compositions(n, steps)]
+
+def print_sweep(results, top=20):
+    print '{:>28} | {:>8} | {:>7} | {:>6}'.format('weights', 'return', 'vol', 'sharpe')
+    for weights, tot_return, tot_vol, sharpe in sorted(results, key=itemgetter(3), reverse=True)[:top]:
+        print '{:>28} | {:>8.2%} | {:>7.2%} | {:>6.2f}'.format(', '.join('{:.2f}'.format(w) for w in weights), tot_return, tot_vol, sharpe)
+
+# Month ends a walk-forward test block needs at least: its returns leave out the last holding period, as backtest's
+# do, and two returns are needed for a volatility.
+MIN_TEST_MONTHS = 3
+
+def simulate_span(inputs, choices, lo, hi, start_cash=50000.00):
+    '''simulates choices, the choices of the month ends lo through hi: positions are opened on lo .. hi - 1 and
+    everything is sold on hi, as backtest would if hi were its last month end'''
+    choices = choices.copy()
+    choices[-1] = -1
+    return simulate(inputs['prices'][lo:hi + 1], inputs['spy_prices'][lo:hi + 1], choices, start_cash)
+
+def walk_forward_folds(months, train, test):
+    '''returns the (train start, test start, test end) month end positions of each fold: each trains on train month
+    ends, and the next test month ends, up to the last one, are traded on its best weights. A trailing block of
+    fewer than MIN_TEST_MONTHS month ends is added to the fold before it.'''
+    if test < MIN_TEST_MONTHS:
+        raise ValueError, "test blocks need at least {} month ends".format(MIN_TEST_MONTHS)
+    folds = [(lo, lo + train, min(lo + train + test, months - 1)) for lo in range(0, months - train - 1, test)]
+    if len(folds) > 1 and folds[-1][2] - folds[-1][1] < MIN_TEST_MONTHS:
+        folds.pop()
+        folds[-1] = folds[-1][:2] + (months - 1,)
+    if folds and folds[-1][2] - folds[-1][1] < MIN_TEST_MONTHS:
+        folds.pop()
+    return folds
+
+def _walk_forward_fold(fold):
+    lo, mid, hi = fold
+    weights, start_cash = _sweep_state['weights'], _sweep_state['start_cash']
+    choices = sweep_choices(_sweep_state['features'][lo:mid + 1], weights)
+    returns, spy_returns, cash, spy_cash = simulate_span(_sweep_state['inputs'], choices, lo, mid, start_cash)
+    tot_return, tot_vol, sharpe = performance(returns, cash, start_cash)
+    best = int(np.nan_to_num(sharpe).argmax()) if len(returns) > 1 else 0
+    return best, (float(tot_return[best]), float(tot_vol[best]), float(sharpe[best]))
+
+@instrument.measure('sweep')
+def walk_forward(c, syms, screener, weight_grid, train=36, test=12, start_cash=50000.00, processes=None, cache=None):
+    '''Walk-forward optimization of screener's weights. For each fold, the weight vector of weight_grid with the best
+    Sharpe ratio over train month ends is used for the next test month ends, and the test blocks are stitched into
+    one out-of-sample run. The folds are searched concurrently by a pool of processes forked with the sweep's inputs
+    in place. Returns a dict of the folds, each with its dates, weights and in-sample and out-of-sample (total return,
+    vol, Sharpe), and the performance of the stitched run and of SPY over it.'''
+    weights = np.array(weight_grid, np.float)
+    if weights.ndim != 2 or weights.shape[1] != len(SWEEP_SCORING[screener][2]):
+        raise ValueError, "{} takes {} weights".format(screener.__name__, len(SWEEP_SCORING[screener][2]))
+    inputs = sweep_inputs(c, syms, screener, cache)
+    folds = walk_forward_folds(len(inputs['dates']), train, test)
+    if not folds:
+        raise ValueError, "{} month ends are too few to train on {} and test on the next {}".format(
+            len(inputs['dates']), train, MIN_TEST_MONTHS)
+    features = sweep_features(inputs, screener)
+    _sweep_state.update(inputs=inputs, features=features, weights=weights, start_cash=start_cash)
+    pool = multiprocessing.Pool(processes)
+    try:
+        searches = pool.map(_walk_forward_fold, folds)
+    finally:
+        pool.close()
+        pool.join()
+        _sweep_state.clear()
+
+    dates = inputs['dates']
+    choices = np.full((len(dates), 1), -1, np.int)
+    results = []
+    for (lo, mid, hi), (best, in_sample) in izip(folds, searches):
+        choices[mid:hi] = sweep_choices(features[mid:hi], weights[best:best + 1])
+        returns, spy_returns, cash, spy_cash = simulate_span(inputs, choices[mid:hi + 1], mid, hi, start_cash)
+        results.append(OrderedDict([
+            ('train', (dates[lo], dates[mid])),
+            ('test', (dates[mid], dates[hi])),
+            ('weights', tuple(weight_grid[best])),
+            ('in_sample', in_sample),
+            ('out_of_sample', tuple(float(v) for v in performance(returns, cash, start_cash))),
+        ]))
+    first, last = folds[0][1], folds[-1][2]
+    returns, spy_returns, cash, spy_cash = simulate_span(inputs, choices[first:last + 1], first, last, start_cash)
+    return {
+        'folds': results,
+        'out_of_sample': tuple(float(v) for v in performance(returns, cash, start_cash)),
+        'spy': tuple(float(v) for v in performance(spy_returns.reshape(-1, 1), np.array([spy_cash]), start_cash)),
+        'period': (dates[first], dates[last]),
+    }
+
+def print_walk_forward(result):
+    print '{:>23} | {:>23} | {:>28} | {:>8} | {:>6} | {:>8} | {:>6}'.format(
+        'train', 'test', 'weights', 'IS ret', 'IS sh', 'OOS ret', 'OOS sh')
+    for fold in result['folds']:
+        print '{:>23} | {:>23} | {:>28} | {:>8.2%} | {:>6.2f} | {:>8.2%} | {:>6.2f}'.format(
+            '{} {}'.format(*fold['train']), '{} {}'.format(*fold['test']),
+            ', '.join('{:.2f}'.format(w) for w in fold['weights']),
+            fold['in_sample'][0], fold['in_sample'][2], fold['out_of_sample'][0], fold['out_of_sample'][2])
+    print 'out of sample {} to {}'.format(*result['period'])
+    for name, (tot_return, tot_vol, sharpe) in (('Walk-forward', result['out_of_sample']), ('SPY', result['spy'])):
+        print '{:>12}: return {:6.2%}  vol {:6.2%}  Sharpe {:6.2f}'.format(name, tot_return, tot_vol, sharpe)
+
+def universes(symbols_filenames, by_category=False):
+    '''returns universe name -> sorted symbols for each symbols file, named after the file, or with by_category
+    for each category of each file, named file:category'''
+    result = OrderedDict()
+    for filename, sym_data in load_symbol_files(symbols_filenames).iteritems():
+        name = os.path.splitext(os.path.basename(filename))[0]
+        if by_category:
+            for cat, syms in sorted(sym_data.iteritems()):
+                result['{}:{}'.format(name, cat)] = sorted(syms)
+        else:
+            result[name] = sorted(sym for syms in sym_data.itervalues() for sym in syms)
+    return result
+
+# Panel and arguments of the batch in progress. Pool workers are forked after this is set, so they share the panel's
+# arrays without pickling.
+_batch_state = {}
+
+def _batch_backtest(item):
+    name, syms = item
+    panel = _batch_state['panel']
+    # A SQLite connection must not be used across a fork, so each worker opens its own.
+    panel.c = sqlite3.connect(_batch_state['db'], detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+    stdout = sys.stdout
+    sys.stdout = log = StringIO()
+    try:
+        summary = backtest(panel, syms, _batch_state['screener'], _batch_state['screener_args'],
+                           _batch_state['start_cash'])
+        error = None
+    except Exception as e:
+        summary, error = None, '{}: {}'.format(e.__class__.__name__, e)
+    finally:
+        sys.stdout = stdout
+        panel.c.close()
+    return name, summary, error, log.getvalue()
+
+@instrument.measure('backtest')
+def batch_backtest(c, db, universes, screener, screener_args, start_cash=50000.00, processes=None):
+    '''Backtests screener on each universe, a name -> symbols dict, and returns [(name, summary, error)] in universe
+    order, where summary is backtest's result or None if it raised error. The quotes of the union of the universes
+    are loaded into one panel, and the backtests are spread over a pool of processes that read db, the database
+    c is connected to. Each backtest's output is printed once it has finished, universe by universe.'''
+    _batch_state.update(panel=c if isinstance(c, PricePanel) else PricePanel(c), db=db, screener=screener,
+                        screener_args=screener_args, start_cash=start_cash)
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = []
+        for name, summary, error, log in pool.imap(_batch_backtest, universes.items()):
+            print '==', name, '=='
+            print log.rstrip('\n')
+            if error:
+                print error
+            results.append((name, summary, error))
+    finally:
+        pool.close()
+        pool.join()
+        _batch_state.clear()
+    return results
+
+def print_comparison(results, universes):
+    '''prints the results of batch_backtest as one line per universe, best Sharpe ratio first'''
+    print '{:>32} | {:>4} | {:>8} | {:>7} | {:>6} | {:>8} | {:>7} | {:>6}'.format(
+        'universe', 'syms', 'return', 'vol', 'sharpe', 'SPY ret', 'SPY vol', 'SPY sh')
+    for name, summary, error in sorted(results, key=lambda r: r[1]['sharpe'] if r[1] else -np.inf, reverse=True):
+        if summary:
+            print '{:>32} | {:>4} | {return:>8.2%} | {vol:>7.2%} | {sharpe:>6.2f} | {spy_return:>8.2%} | {spy_vol:>7.2%} | {spy_sharpe:>6.2f}'.format(
+                name, len(universes[name]), **summary)
+        else:
+            print '{:>32} | {:>4} | failed: {}'.format(name, len(universes[name]), error)
+
+class BulkWriter:
+    '''Buffers rows for one table and inserts them with executemany, BULK_CHUNK rows at a time. All rows go into a
+    single transaction that is committed by close(), or on leaving a with block without an exception.'''
+    def __init__(self, c, table, columns, chunk=BULK_CHUNK, verb='INSERT'):
+        self.c = c
+        self.sql = '{} INTO {} ({}) VALUES ({})'.format(verb, table, ', '.join(columns), ','.join('?' * len(columns)))
+        self.chunk = chunk
+        self.rows = []
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk:
+            self.flush()
+
+    def extend(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        for i in range(0, len(self.rows), self.chunk):
+            self.c.executemany(self.sql, self.rows[i:i + self.chunk])
+        self.count += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.c.commit()
+
+class ScreenCache:
+    '''Memoizes screener and metrics query results, keyed on the function, its arguments and the data version, so
+    changes to quote or the derived tables invalidate them. The most recently used size results are kept in memory.
+    With a path, results are also stored in that SQLite database and survive across runs until the data changes.'''
+    def __init__(self, size=SCREEN_CACHE_SIZE, path=None):
+        self.size = size
+        self.results = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path)
+            self.db.execute('''
+CREATE TABLE IF NOT EXISTS screen_cache (
+    key TEXT PRIMARY KEY,
+    version TEXT,
+    result BLOB NOT NULL
+)''')
 
-def dict_q(c, table, key_col, value_col):
+    def call(self, fn, c, *args, **kwargs):
+        '''returns fn(c, *args), from the cache if it was computed for the same data. Callers making many calls on
+        unchanged data pass the data version they read once as version, instead of having it read on every call.'''
+        version = kwargs['version'] if 'version' in kwargs else data_version(c)
+        if version != self.version:
+            self.clear(version)
+        key = repr((fn.__name__, freeze(args), version))
+        if key in self.results:
+            self.hits += 1
+            result = self.results[key] = self.results.pop(key)
+            return result
+        row = self.db and self.db.execute('SELECT result FROM screen_cache WHERE key = ?', (key,)).fetchone()
+        if row:
+            self.hits += 1
+            result = cPickle.loads(str(row[0]))
+        else:
+            self.misses += 1
+            result = fn(c, *args)
+            if self.db:
+                self.db.execute('INSERT OR REPLACE INTO screen_cache (key, version, result) VALUES (?,?,?)',
+                                (key, version, buffer(cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL))))
+                self.db.commit()
+        self.results[key] = result
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+        return result
+
+    def clear(self, version=None):
+        '''drops every result not computed for version'''
+        self.results.clear()
+        self.version = version
+        if self.db:
+            self.db.execute('DELETE FROM screen_cache WHERE version IS NOT ?', (version,))
+            self.db.commit()
+
+def freeze(v):
+    '''returns v with sequences turned into tuples and dates and strings into str, so equal arguments have equal
+    reprs'''
+    if isinstance(v, (list, tuple, np.ndarray)):
+        return tuple(freeze(i) for i in v)
+    if isinstance(v, (basestring, datetime.date)):
+        return str(v)
+    return v
+
+# Tables in import order, each with the query that exports it with symbols, durations and dates in place of ids and
+# the statement that imports one exported row. Columns named sym are stored as positions in the symbols index and
+# columns ending in dt as positions in the dates index.
+COLUMN_TABLES = [
+    ('symbol', 'SELECT sym, description FROM symbol',
+     'INSERT INTO symbol (sym, description) VALUES (?,?)'),
+    ('quote', '''
+SELECT s.sym, q.dt, q.open, q.high, q.low, q.close, q.volume, q.adjClose
+FROM quote q NATURAL JOIN symbol s
+ORDER BY s.sym, q.dt''',
+     '''
+INSERT INTO quote (sym_id, dt, open, high, low, close, volume, adjClose)
+VALUES ((SELECT sym_id FROM symbol WHERE sym = ?), ?, ?, ?, ?, ?, ?, ?)'''),
+    ('period', '''
+SELECT d.days, p.start_dt, p.end_dt
+FROM period p NATURAL JOIN duration d
+ORDER BY p.period_id''',
+     'INSERT INTO period (duration_id, start_dt, end_dt) VALUES ((SELECT duration_id FROM duration WHERE days = ?), ?, ?)'),
+] + [
+    (table, '''
+SELECT s.sym, d.days, p.end_dt, x.{0}
+FROM {0} x NATURAL JOIN symbol s NATURAL JOIN period p NATURAL JOIN duration d
+ORDER BY s.sym, d.days, p.end_dt'''.format(table),
+     '''
+INSERT INTO {0} (sym_id, period_id, {0})
+VALUES ((SELECT sym_id FROM symbol WHERE sym = ?),
+        (SELECT p.period_id FROM period p NATURAL JOIN duration d WHERE d.days = ? AND p.end_dt = ?),
+        ?)'''.format(table))
+    for table in ('return', 'volatility', 'ulcer_index')
+] + [
+    ('parabolic_sar', '''
+SELECT s.sym, x.dt, x.long_short, x.parabolic_sar
+FROM parabolic_sar x NATURAL JOIN symbol s
+ORDER BY s.sym, x.dt''',
+     '''
+INSERT INTO parabolic_sar (sym_id, dt, long_short, parabolic_sar)
+VALUES ((SELECT sym_id FROM symbol WHERE sym = ?), ?, ?, ?)'''),
+    ('parabolic_sar_state', '''
+SELECT s.sym, x.dt, x.long_short, x.parabolic_sar, x.af, x.extreme_point
+FROM parabolic_sar_state x NATURAL JOIN symbol s
+ORDER BY s.sym''',
+     '''
+INSERT INTO parabolic_sar_state (sym_id, dt, long_short, parabolic_sar, af, extreme_point)
+VALUES ((SELECT sym_id FROM symbol WHERE sym = ?), ?, ?, ?, ?, ?)'''),
+    ('screen_metric', '''
+SELECT s.sym, m.end_dt, m.month_return, m.quarter_return, m.month_volatility, m.quarter_volatility
+FROM screen_metric m NATURAL JOIN symbol s
+ORDER BY s.sym, m.end_dt''',
+     '''
+INSERT INTO screen_metric (sym_id, end_dt, month_return, quarter_return, month_volatility, quarter_volatility)
+VALUES ((SELECT sym_id FROM symbol WHERE sym = ?), ?, ?, ?, ?, ?)'''),
+    ('watermark', '''
+SELECT s.sym, w.metric, w.last_dt
+FROM watermark w NATURAL JOIN symbol s
+ORDER BY s.sym, w.metric''',
+     'INSERT INTO watermark (sym_id, metric, last_dt) VALUES ((SELECT sym_id FROM symbol WHERE sym = ?), ?, ?)'),
+    # The stage records and versions, so derive finds the imported tables as up to date as they were exported.
+    ('meta', 'SELECT key, value FROM meta ORDER BY key',
+     'INSERT OR REPLACE INTO meta (key, value) VALUES (?,?)'),
+]
+
+# Columns of the panel table export_columns writes for PricePanel, each a dates x symbols array flattened dates first.
+PANEL_COLUMNS = ('adjClose', 'high', 'low', 'return')
+
+def column_names(c, query):
+    return [d[0] for d in c.execute(query + ' LIMIT 0').description]
+
+@instrument.measure('stage')
+def export_columns(c, directory):
+    '''Writes the source and derived tables to directory as one .npy file per column, with the symbols and trading
+    days stored once as index files.'''
+    syms = colstore.save_index(directory, 'symbols', col_query(c, 'SELECT sym FROM symbol'))
+    dates = colstore.save_index(directory, 'dates', map(str, col_query(c, 'SELECT DISTINCT dt FROM quote')))
+    for table, query, insert in COLUMN_TABLES:
+        print 'export', table
+        names = column_names(c, query)
+        rows = c.execute(query).fetchall()
+        columns = {}
+        for name, values in izip(names, zip(*rows) if rows else [()] * len(names)):
+            if name == 'sym':
+                columns[name] = colstore.encode(values, syms)
+            elif name.endswith('dt'):
+                columns[name] = colstore.encode(map(str, values), dates)
+            elif values and isinstance(values[0], basestring):
+                columns[name] = np.array(values, np.str_)
+            else:
+                columns[name] = np.array(values)
+        colstore.save(directory, table, columns)
+    print 'export panel'
+    quote = colstore.load(directory, 'quote')
+    arrays = panel_arrays((len(dates), len(syms)), quote['dt'], quote['sym'], quote['adjClose'], quote['high'], quote['low'])
+    colstore.save(directory, 'panel', dict(zip(PANEL_COLUMNS, [a.ravel() for a in arrays])))
+
+@instrument.measure('stage')
+@changes_data
+def import_columns(c, directory):
+    '''Loads every table written by export_columns into the empty tables of c, as created by create_source_tables
+    and create_derived_tables.'''
+    syms = colstore.load_index(directory, 'symbols')
+    dates = colstore.load_index(directory, 'dates')
+    for table, query, insert in COLUMN_TABLES:
+        print 'import', table
+        columns = colstore.load(directory, table)
+        values = []
+        for name in column_names(c, query):
+            a = columns[name]
+            if name == 'sym':
+                a = colstore.decode(a, syms)
+            elif name.endswith('dt'):
+                a = colstore.decode(a, dates)
+            values.append(a.tolist())
+        c.executemany(insert, izip(*values))
+    c.commit()
+
+def load_columns(c, directory):
+    '''Replaces the tables of c, and every meta record but the data version, with those of the column store in
+    directory.'''
+    c.execute("DELETE FROM meta WHERE key != 'data_version'")
+    create_source_tables(c)
+    create_derived_tables(c)
+    import_columns(c, directory)
+
+class QueryPlans:
+    '''Wraps a connection and records the EXPLAIN QUERY PLAN of each statement run through it, as (sql, details).'''
+    def __init__(self, c):
+        self.c = c
+        self.plans = []
+
+    def __getattr__(self, name):
+        return getattr(self.c, name)
+
+    def execute(self, sql, args=()):
+        self.plans.append((sql, [r[-1] for r in self.c.execute('EXPLAIN QUERY PLAN ' + sql, args)]))
+        return self.c.execute(sql, args)
+
+# Access paths of the screeners and backtest, each run against QueryPlans by check_query_plans.
+ACCESS_PATHS = [
+    ('return_vol_metrics', lambda c, syms, dt: return_vol_metrics(c, syms, dt)),
+    ('sharpe_metrics', lambda c, syms, dt: sharpe_metrics(c, syms, dt)),
+    ('daily_returns', lambda c, syms, dt: daily_returns(c, syms[0], START_DATE, dt)),
+    ('price', lambda c, syms, dt: price(c, syms[0], dt)),
+    ('month_ends', lambda c, syms, dt: month_ends(c)),
+]
+
+def index_only(detail):
+    '''returns whether a query plan step reads only an index or the primary key b-tree of a WITHOUT ROWID table,
+    never a table row found through a separate index or a rowid'''
+    if not detail.startswith(('SEARCH', 'SCAN')):
+        return True
+    if 'INTEGER PRIMARY KEY' in detail:
+        return False
+    return 'COVERING INDEX' in detail or 'PRIMARY KEY' in detail or detail.startswith('SCAN CONSTANT')
+
+def plans_fixture(symbols=8, years=2, seed=0):
+    '''returns an in-memory database built from synthetic quotes for symbols over years, with every derived table'''
+    c = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+    start_date = str(datetime.datetime.strptime(END_DATE, '%Y-%m-%d').date() - datetime.timedelta(int(years * 365.25)))
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        create_source_tables(c)
+        c.executemany('INSERT INTO symbol (sym, description) VALUES (?,?)',
+                      [(sym, 'Synthetic ' + sym) for sym in synthetic.synthetic_symbols(symbols)])
+        insert_quotes(c, start_date, END_DATE, fetch=synthetic.synthetic_fetch(seed))
+        derive(c, INDICATORS.keys())
+    finally:
+        sys.stdout = stdout
+    return c
+
+def check_query_plans(c, syms=None, dt=None):
+    '''returns [(access path, sql, plan details, whether every step is index only)] for ACCESS_PATHS, run on dt, by
+    default the last quoted day, for syms, by default every symbol quoted on dt'''
+    dt = dt or scalar_query(c, 'SELECT MAX(dt) FROM quote')
+    syms = syms or [sym for sym, in c.execute('SELECT s.sym FROM quote q NATURAL JOIN symbol s WHERE q.dt = ? ORDER BY s.sym',
+                                              (dt,))]
+    if not syms:
+        raise ValueError, "no symbol is quoted on {}".format(dt)
+    results = []
+    for name, run in ACCESS_PATHS:
+        plans = QueryPlans(c)
+        run(plans, syms, dt)
+        for sql, details in plans.plans:
+            results.append((name, sql, details, all(index_only(d) for d in details)))
+    return results
+
+def apply_pragmas(c, profile):
+    for name, value in sorted(PRAGMA_PROFILES[profile].iteritems()):
+        c.execute('PRAGMA {} = {}'.format(name, value))
+
+def panel_arrays(shape, ii, jj, adj_close, high, low):
+    '''returns shape arrays of adjClose, high, low and daily return, with the quotes at rows ii and columns jj and NaN
+    elsewhere'''
+    arrays = [np.full(shape, np.nan) for i in range(4)]
+    for a, values in izip(arrays, (adj_close, high, low)):
+        a[ii, jj] = values
+    # Same arithmetic as compute_returns: a return exists only where both consecutive trading days were quoted.
+    adj_close, returns = arrays[0], arrays[3]
+    returns[1:] = (adj_close[1:] - adj_close[:-1]) / adj_close[:-1]
+    return arrays
+
+class PricePanel:
+    '''Dates x symbols arrays of adjClose, high and low loaded from quote in a single query, plus the daily returns
+    derived from adjClose. Missing quotes are NaN. A panel can be passed wherever a connection is expected: price()
+    and daily_returns() are then served by array lookups and everything else goes to the wrapped connection.
+    With store, the arrays are read-only memory maps of the panel written by export_columns, so they are not copied
+    and every process that maps the store shares their pages.'''
+    def __init__(self, c, store=None):
+        print 'load price panel'
+        self.c = c
+        if store:
+            meta = colstore.load(store, 'meta')
+            if dict(izip(meta['key'].tolist(), meta['value'].tolist())).get('data_version') != data_version(c):
+                raise ValueError, "the column store in {} is out of date; run derive --export-columns again".format(store)
+            self.syms = colstore.load_index(store, 'symbols').tolist()
+            self.dates = np.array(colstore.load_index(store, 'dates'))
+            shape = (len(self.dates), len(self.syms))
+            panel = colstore.load(store, 'panel')
+            self.adj_close, self.high, self.low, self.returns = [panel[name].reshape(shape) for name in PANEL_COLUMNS]
+        else:
+            # The CAST leaves dt without a declared type, so it is not converted to a datetime.date and back.
+            rows = c.execute('SELECT s.sym, CAST(q.dt AS TEXT), q.adjClose, q.high, q.low FROM quote q NATURAL JOIN symbol s').fetchall()
+            syms, dts, adj_close, high, low = zip(*rows) if rows else ((),) * 5
+            dts = map(str, dts)
+            self.syms = sorted(set(syms))
+            self.dates = np.array(sorted(set(dts)))
+        self.sym_index = {sym: i for i, sym in enumerate(self.syms)}
+        self.date_index = {dt: i for i, dt in enumerate(self.dates)}
+        if not store:
+            ii = [self.date_index[dt] for dt in dts]
+            jj = [self.sym_index[sym] for sym in syms]
+            self.adj_close, self.high, self.low, self.returns = panel_arrays(
+                (len(self.dates), len(self.syms)), ii, jj, adj_close, high, low)
+
+    def __getattr__(self, name):
+        return getattr(self.c, name)
+
+    def price(self, sym, dt):
+        p = self.adj_close[self.date_index[str(dt)], self.sym_index[sym]]
+        if np.isnan(p):
+            raise IndexError('no quote for {} on {}'.format(sym, dt))
+        return p
+
+    def date_slice(self, start_dt, end_dt):
+        '''returns the row slice for start_dt < dt <= end_dt'''
+        return slice(np.searchsorted(self.dates, str(start_dt), 'right'), np.searchsorted(self.dates, str(end_dt), 'right'))
+
+    def daily_returns(self, sym, start_dt, end_dt):
+        r = self.returns[self.date_slice(start_dt, end_dt), self.sym_index[sym]]
+        return r[~np.isnan(r)]
+
+def dict_q(c, table, key_col, value_col, group_by=None):
     '''returns a q_col_i -> id_col_i dict'''
-    return dict(c.execute('select {}, {} from {}'.format(key_col, value_col, table)).fetchall())
+    query = 'select {}, {} from {}'.format(key_col, value_col, table)
+    if group_by:
+        query += ' group by ' + group_by
+    return dict(c.execute(query).fetchall())
 
 def truncate(c, table):
     c.execute('delete from {}'.format(table))
@@ -585,6 +1498,10 @@ def drop(c, *tables):
     for t in tables:
         c.execute('drop table if exists ' + t)
 
+def next_day(dt):
+    '''returns the ISO date string of the day after dt'''
+    return str(datetime.datetime.strptime(str(dt), '%Y-%m-%d').date() + datetime.timedelta(1))
+
 def month_ends(c):
     return col_query(c, "SELECT MAX(dt) AS end_dt FROM quote GROUP BY date(dt, 'start of month') ORDER BY end_dt")
 
@@ -595,12 +1512,16 @@ def col_query(c, query, *args):
     return tuple(r[0] for r in c.execute(query, args).fetchall())
 
 def price(c, sym, dt):
+    if isinstance(c, PricePanel):
+        return c.price(sym, dt)
     return scalar_query(c, "SELECT q.adjClose FROM quote q NATURAL JOIN symbol s WHERE s.sym = ? AND q.dt = ?", sym, dt)
 
 def symbols(c):
     return col_query(c, "SELECT s.sym FROM symbol s")
 
 def daily_returns(c, sym, start_dt, end_dt):
+    if isinstance(c, PricePanel):
+        return c.daily_returns(sym, start_dt, end_dt)
     return map(float, col_query(c, """
 SELECT r.return
 FROM return r,
@@ -615,37 +1536,246 @@ WHERE r.sym_id = s.sym_id
       AND ? < p.end_dt AND p.end_dt <= ?""", sym, start_dt, end_dt))
 
 def avg(s):
+    if isinstance(s, np.ndarray):
+        return s.mean()
     return sum(s) / len(s)
 
 def stdev(s):
     a = avg(s)
-    sdsq = sum([(i - a) ** 2 for i in s])
+    if isinstance(s, np.ndarray):
+        sdsq = np.square(s - a).sum()
+    else:
+        sdsq = sum([(i - a) ** 2 for i in s])
     stdev = (sdsq / max(len(s) - 1, 1)) ** 0.5
     return stdev
 
+def input_hash(*inputs):
+    return hashlib.sha1(repr(inputs)).hexdigest()
+
+def ingest(c, symbols_filename, start_date, end_date, incremental=False, force=False, cache=None):
+    '''Loads symbols and quotes unless the symbols file and date range are the ones last loaded. Records the data
+    version it leaves behind as quote_version, which derive() checks against.'''
+    contents = []
+    for filename in symbol_files(symbols_filename):
+        with open(filename) as f:
+            contents.append(f.read())
+    digest = input_hash(contents[0] if len(contents) == 1 else contents, start_date, end_date)
+    if not (incremental or force) and get_meta(c, 'stage:ingest') == digest:
+        print 'quotes up to date'
+        return
+    create_source_tables(c, incremental)
+    insert_symbols(c, symbols_filename, incremental)
+    insert_quotes(c, start_date, end_date, incremental, cache=cache)
+    set_meta(c, 'stage:ingest', digest)
+    set_meta(c, 'quote_version', data_version(c))
+
+def sync_durations(c):
+    '''makes the duration table hold DURATIONS, deleting the periods of the durations that are no longer in it'''
+    removed = [(duration_id,) for duration_id, unit, unit_qty, days in c.execute('SELECT duration_id, unit, unit_qty, days FROM duration').fetchall()
+               if (unit, unit_qty, days) not in DURATIONS]
+    c.executemany('DELETE FROM period WHERE duration_id = ?', removed)
+    c.executemany('DELETE FROM duration WHERE duration_id = ?', removed)
+    c.executemany('INSERT OR IGNORE INTO duration (unit, unit_qty, days) VALUES (?,?,?)', DURATIONS)
+
+def derive(c, names, force=False):
+    '''Computes the indicators names depend on that were not yet computed from the current quotes. With force the
+    derived tables are rebuilt from scratch.'''
+    if force:
+        c.execute("DELETE FROM meta WHERE key LIKE 'stage:%' AND key != 'stage:ingest'")
+    digest = input_hash(get_meta(c, 'quote_version'), DURATIONS)
+    stale = [name for name in required_indicators(*names) if get_meta(c, 'stage:' + name) != digest]
+    if not stale:
+        print 'derived tables up to date'
+        return
+    # Derived tables that derive never built, such as those of a database built before it existed, can hold rows but
+    # no watermarks, so they are rebuilt rather than appended to. So are those built for other durations, whose
+    # watermarks say nothing about the periods of a new one.
+    durations = input_hash(DURATIONS)
+    incremental = (not force and get_meta(c, 'durations') == durations and
+                   any(get_meta(c, 'stage:' + name) is not None for name in INDICATORS))
+    if not incremental:
+        sync_durations(c)
+        set_meta(c, 'durations', durations)
+        c.execute("DELETE FROM meta WHERE key LIKE 'stage:%' AND key != 'stage:ingest'")
+        stale = required_indicators(*names)
+    create_derived_tables(c, defer_indexes=True, incremental=incremental)
+    for name in stale:
+        INDICATORS[name][0](c)
+        set_meta(c, 'stage:' + name, digest)
+
+SCREENERS = dict((screener.__name__, screener) for screener in SCREENER_INDICATORS)
+
+# Weights each screener uses when none are given on the command line.
+SCREENER_WEIGHTS = {
+    'return_vol_screen': (0.4, 0.3, 0, 0.3),
+    'return_vol_ranked_screen': (.18, .72, 0, .1),
+    'sharpe_screen': (0.2,) * 5,
+    'sharpe_screen2': (),
+}
+
+def screen_dates(c, dt=None):
+    '''returns the (start, end) of the last screening period ending on or before dt, or of the last one'''
+    ends = month_ends(c)
+    n = bisect_right(ends, str(dt)) if dt else len(ends)
+    if not n:
+        raise ValueError, "no month end on or before {}".format(dt)
+    return (ends[n - 2] if n > 1 else scalar_query(c, "SELECT MIN(dt) FROM quote")), ends[n - 1]
+
+def cmd_ingest(c, args):
+    if args.from_columns:
+        load_columns(c, args.from_columns)
+        return
+    cache = quotecache.QuoteCache(QUOTE_CACHE_DIR, QUOTE_CACHE_TTL, QUOTE_CACHE_BYTES) if args.cache else None
+    ingest(c, args.symbols_file, args.start, args.end, args.incremental, args.force, cache)
+
+def cmd_derive(c, args):
+    derive(c, args.indicators or INDICATORS.keys(), args.force)
+    if args.export_columns:
+        export_columns(c, args.export_columns)
+
+def cmd_screen(c, args):
+    screener = SCREENERS[args.screener]
+    derive(c, SCREENER_INDICATORS[screener])
+    start_dt, end_dt = screen_dates(c, args.date)
+    panel = PricePanel(c, args.columns)
+    if args.screen_cache:
+        result = ScreenCache(path=SCREEN_CACHE_DB).call(screener, panel, args.syms, start_dt, end_dt, args.weights)
+    else:
+        result = screener(panel, args.syms, start_dt, end_dt, args.weights)
+    print '\n'.join(map(str, result))
+
+def cmd_backtest(c, args):
+    screener = SCREENERS[args.screener]
+    derive(c, SCREENER_INDICATORS[screener])
+    # Each month is screened once, so only a cache that persists across runs pays for itself.
+    cache = ScreenCache(path=SCREEN_CACHE_DB) if args.screen_cache else None
+    panel = PricePanel(c, args.columns)
+    summary = backtest(panel, args.syms, screener, args.weights, cache=cache)
+    if args.significance:
+        boot = significance.bootstrap(summary['returns'], summary['spy_returns'], args.significance, seed=args.seed)
+        rand = significance.random_portfolios(summary['returns'], period_returns(panel, args.syms, summary['periods']),
+                                              args.significance, seed=args.seed)
+        print significance.report(boot, rand)
+
+def cmd_batch(c, args):
+    screener = SCREENERS[args.screener]
+    cache = quotecache.QuoteCache(QUOTE_CACHE_DIR, QUOTE_CACHE_TTL, QUOTE_CACHE_BYTES) if args.cache else None
+    ingest(c, args.symbols_files, args.start, args.end, args.incremental, cache=cache)
+    derive(c, SCREENER_INDICATORS[screener])
+    batch = universes(args.symbols_files, args.by_category)
+    results = batch_backtest(PricePanel(c, args.columns), args.db, batch, screener, args.weights, processes=args.processes)
+    print_comparison(results, batch)
+
+def cmd_plans(c, args):
+    results = check_query_plans(c if args.on_db else plans_fixture(), args.syms)
+    for name, sql, details, ok in results:
+        print '{:<20} {}'.format(name, 'index only' if ok else 'READS TABLE ROWS')
+        for detail in details:
+            print '    ' + detail
+    if not all(ok for name, sql, details, ok in results):
+        sys.exit(1)
+
+def cmd_walkforward(c, args):
+    screener = SCREENERS[args.screener]
+    derive(c, SCREENER_INDICATORS[screener])
+    grid = simplex_grid(len(SWEEP_SCORING[screener][2]), args.steps)
+    print_walk_forward(walk_forward(PricePanel(c, args.columns), args.syms, screener, grid, args.train, args.test,
+                                    processes=args.processes))
+
+def parse_args(argv):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--db', default=DB_FILENAME)
+    common.add_argument('--instrument', action='store_true', help='print timings, rows and statements per stage')
+    common.add_argument('--profile', action='store_true', help='also write a cProfile dump per stage to ' + PROFILE_DIR)
+    parser = argparse.ArgumentParser(description='Backtests ETF rotation screeners on daily quotes.')
+    commands = parser.add_subparsers(dest='command')
+
+    p = commands.add_parser('ingest', help='download symbols and quotes', parents=[common])
+    p.add_argument('--symbols-file', default=SYMBOLS_FILENAME)
+    p.add_argument('--start', default=START_DATE)
+    p.add_argument('--end', default=END_DATE)
+    p.add_argument('--incremental', action='store_true', help='only download quotes after the last stored ones')
+    p.add_argument('--cache', action='store_true', help='keep downloads in ' + QUOTE_CACHE_DIR)
+    p.add_argument('--force', action='store_true', help='reload even if the inputs are unchanged')
+    p.add_argument('--from-columns', metavar='DIR', help='load every table from a column store instead of downloading')
+    p.set_defaults(run=cmd_ingest)
+
+    p = commands.add_parser('derive', help='compute derived tables', parents=[common])
+    p.add_argument('--indicators', nargs='+', choices=sorted(INDICATORS), help='default: all')
+    p.add_argument('--force', action='store_true', help='rebuild the derived tables from scratch')
+    p.add_argument('--fast-unsafe', action='store_true',
+                   help='skip fsyncs and journal in memory; a crash meanwhile can corrupt the whole database')
+    p.add_argument('--export-columns', metavar='DIR', nargs='?', const=COLUMN_STORE_DIR,
+                   help='also write the tables to a column store in DIR, by default ' + COLUMN_STORE_DIR)
+    p.set_defaults(run=cmd_derive)
+
+    for name, run, help in (('screen', cmd_screen, 'print one screen'), ('backtest', cmd_backtest, 'backtest a screener')):
+        p = commands.add_parser(name, help=help, parents=[common])
+        p.add_argument('--screener', choices=sorted(SCREENERS), default='sharpe_screen2')
+        p.add_argument('--weights', nargs='*', type=float, help='default: the weights of the screener')
+        p.add_argument('--syms', nargs='+', default=DEFAULT_SYMS)
+        p.add_argument('--screen-cache', action='store_true', help='persist screens in ' + SCREEN_CACHE_DB)
+        p.add_argument('--columns', metavar='DIR', nargs='?', const=COLUMN_STORE_DIR,
+                       help='read prices from the column store in DIR, by default ' + COLUMN_STORE_DIR)
+        p.set_defaults(run=run)
+
+    p = commands.add_parser('batch', help='backtest a screener on several universes', parents=[common])
+    p.add_argument('--symbols-files', nargs='+', default=['symbols.yml', 'symbols2.yml', '401k.yml'],
+                   help='one universe per file; their symbols are loaded together')
+    p.add_argument('--by-category', action='store_true', help='one universe per category of each file instead')
+    p.add_argument('--screener', choices=sorted(SCREENERS), default='sharpe_screen2')
+    p.add_argument('--weights', nargs='*', type=float, help='default: the weights of the screener')
+    p.add_argument('--start', default=START_DATE)
+    p.add_argument('--end', default=END_DATE)
+    p.add_argument('--incremental', action='store_true', help='only download quotes after the last stored ones')
+    p.add_argument('--cache', action='store_true', help='keep downloads in ' + QUOTE_CACHE_DIR)
+    p.add_argument('--processes', type=int, help='backtests to run at once; default: one per CPU')
+    p.add_argument('--columns', metavar='DIR', nargs='?', const=COLUMN_STORE_DIR,
+                   help='read prices from the column store in DIR, by default ' + COLUMN_STORE_DIR)
+    p.set_defaults(run=cmd_batch)
+
+    p = commands.add_parser('plans', help='check that the screener and backtest queries are index only',
+                            parents=[common])
+    p.add_argument('--on-db', action='store_true', help='check the --db database instead of a synthetic one')
+    p.add_argument('--syms', nargs='+', help='default: every symbol quoted on the last day')
+    p.set_defaults(run=cmd_plans)
+    p = commands.add_parser('walkforward', help='optimize screener weights walk-forward', parents=[common])
+    p.add_argument('--screener', choices=sorted(s.__name__ for s in SWEEP_SCORING), default='return_vol_ranked_screen')
+    p.add_argument('--syms', nargs='+', default=DEFAULT_SYMS)
+    p.add_argument('--steps', type=int, default=10, help='search the weights that are multiples of 1 / STEPS')
+    p.add_argument('--train', type=int, default=36, help='month ends to train each fold on')
+    p.add_argument('--test', type=int, default=12, help='month ends each fold trades out of sample')
+    p.add_argument('--processes', type=int, help='folds to search at once; default: one per CPU')
+    p.add_argument('--columns', metavar='DIR', nargs='?', const=COLUMN_STORE_DIR,
+                   help='read prices from the column store in DIR, by default ' + COLUMN_STORE_DIR)
+    p.set_defaults(run=cmd_walkforward)
+
+    commands.choices['backtest'].add_argument('--significance', metavar='N', type=int,
+                                              help='also bootstrap the excess over SPY and compare with N random portfolios')
+    commands.choices['backtest'].add_argument('--seed', type=int, help='seed of the resampling')
+    commands.choices['screen'].add_argument('--date', help='screen the month ending on or before DATE; default: the last')
+    args = parser.parse_args(argv)
+    if args.command in ('screen', 'backtest', 'batch'):
+        default = SCREENER_WEIGHTS[args.screener]
+        args.weights = default if args.weights is None else tuple(args.weights)
+        if len(args.weights) != len(default):
+            parser.error('{} takes {} weights'.format(args.screener, len(default)))
+    return args
+
 def main():
-##    syms = 'VTI VEU VWO BLV'.split()
-##    syms = 'RSP BLV EWA DBC VWO SHY'.split()
-    syms = 'DBC EFA SPY TLT VNQ BLV VWO BOND'.split()
-    with sqlite3.connect('prices.db', detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES) as c:
-        create_source_tables(c)
-        insert_symbols(c, 'symbols.yml')
-##        syms = list(symbols(c))
-##        syms.remove('MS')
-        insert_quotes(c, START_DATE, END_DATE)
-        compute_periods(c)
-        create_derived_tables(c)
-        compute_returns(c)
-        compute_volatility(c)
-        compute_ulcer_index(c)
-        compute_parabolic_sar(c)
-##        print '\n'.join(map(str, return_vol_ranked_screen(c, syms, datetime.date(2012, 7, 17), (0.4, 0.3, 0, 0.3))))
-##        print '\n'.join(map(str, sharpe_screen(c, 'SPY SHY TIP TLT BLV QQQ GLD VNQ EWA VWO'.split(), datetime.date(2012, 7, 10), (0.5, 0.5))))
-        #cProfile.runctx('backtest(c, syms, return_vol_screen, (0.4, 0.3, 0, 0.3))', globals(), locals())
-        #backtest(c, syms, return_vol_ranked_screen, (.18, .72, 0, .1))
-        backtest(c, syms, sharpe_screen2, ())
-        print sharpe_screen2(c, syms, datetime.date(2013,2,1), datetime.date(2013,3,1), ())
-        #backtest(c, ('SPY',), sharpe_screen, (0.6, 0.4))
+    args = parse_args(sys.argv[1:])
+    if args.instrument or args.profile:
+        instrument.enable(PROFILE_DIR if args.profile else None)
+    with sqlite3.connect(args.db, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES) as c:
+        if args.instrument or args.profile:
+            c = instrument.TracingConnection(c)
+        apply_pragmas(c, 'build' if getattr(args, 'fast_unsafe', False) else 'default')
+        create_meta_table(c)
+        args.run(c, args)
+    if args.instrument or args.profile:
+        print instrument.summary()
+        for path in instrument.dump_profiles():
+            print 'wrote', path
 
 if __name__ == '__main__':
     main()
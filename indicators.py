@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""
+This is the "indicators" module.
+
+Vectorized kernels for the rolling indicators stored by etf-backtest.py. Each
+kernel takes the full, date-ordered history of one symbol as a NumPy array and
+returns one value per complete window, in window order.
+
+sample usage:
+>>> import numpy as np, indicators
+>>> indicators.rolling_std(np.array([1., 2., 4., 8.]), 3)
+array([1.24721913, 2.49443826])
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+# Number of windows materialized at once by the windowed kernels; bounds their
+# temporary memory to roughly BLOCK * window * 8 bytes.
+BLOCK = 4096
+
+
+def windows(a, size):
+    """
+    Returns a read-only (len(a) - size + 1, size) view of every contiguous
+    window of the 1-d array a. No data is copied.
+    """
+    a = np.ascontiguousarray(a)
+    n = len(a) - size + 1
+    if n <= 0:
+        return np.empty((0, size), a.dtype)
+    return as_strided(a, shape=(n, size), strides=(a.strides[0], a.strides[0]), writeable=False)
+
+
+def rolling_std(a, size, exact=True):
+    """
+    Population standard deviation of every window of size elements of a.
+
+    With exact=True each window is reduced with the same two-pass algorithm as
+    ndarray.std(), so results are bit-identical to calling a[i:i + size].std()
+    per window. With exact=False the windows are updated in O(1) each from
+    running sums, which is faster for long windows but may differ in the last
+    few bits.
+    """
+    a = np.asarray(a, np.float)
+    if len(a) < size:
+        return np.empty(0)
+    if not exact:
+        return _rolling_std_sums(a, size)
+    w = windows(a, size)
+    return np.concatenate([w[i:i + BLOCK].std(axis=1) for i in range(0, len(w), BLOCK)])
+
+
+def _rolling_std_sums(a, size):
+    # Shifting by the mean keeps the running sums small, which limits the
+    # cancellation in E[x^2] - E[x]^2.
+    x = a - a.mean()
+    s1 = np.concatenate(([0.], np.cumsum(x)))
+    s2 = np.concatenate(([0.], np.cumsum(x * x)))
+    w1 = s1[size:] - s1[:-size]
+    w2 = s2[size:] - s2[:-size]
+    var = (w2 - w1 * w1 / size) / size
+    return np.sqrt(np.maximum(var, 0))
+
+
+def rolling_ulcer_index(a, size, n=None):
+    """
+    Ulcer index of every window of size prices of a.
+
+    Drawdowns are measured in percent against the running maximum since the
+    start of each window, and the squared drawdowns are summed left to right
+    and divided by n (size by default) before taking the square root. The
+    summation order matches a scalar loop over the window, so results are
+    bit-identical to one.
+    """
+    a = np.asarray(a, np.float)
+    if len(a) < size:
+        return np.empty(0)
+    n = size if n is None else n
+    w = windows(a, size)
+    ssq = np.empty(len(w))
+    for i in range(0, len(w), BLOCK):
+        block = w[i:i + BLOCK]
+        running_max = np.maximum.accumulate(block, axis=1)
+        drawdown = 100 * (block - running_max) / running_max
+        # np.power goes through libm pow like Python's ** does; x * x and sqrt can differ from it in the last bit.
+        ssq[i:i + BLOCK] = np.cumsum(np.power(drawdown, 2.0), axis=1)[:, -1]
+    return np.power(ssq / n, 0.5)
+
+
+# Positions held by the Parabolic SAR kernel.
+LONG = 1
+SHORT = -1
+
+
+def pad(arrays, fill=0.):
+    """
+    Stacks 1-d arrays of different lengths into one (len(arrays), longest)
+    array, padding the tail of each row with fill. The result always has at
+    least one column. Returns it together with the row lengths.
+    """
+    lengths = np.array([len(a) for a in arrays], np.intp)
+    out = np.empty((len(arrays), max(lengths.max() if len(arrays) else 0, 1)))
+    out.fill(fill)
+    for i, a in enumerate(arrays):
+        out[i, :len(a)] = a
+    return out, lengths
+
+
+def parabolic_sar(highs, lows, state=None):
+    """
+    Runs the Parabolic SAR state machine over many symbols at once.
+
+    highs and lows are lists holding one date-ordered 1-d array per symbol. All
+    symbols are stepped together one bar at a time, with their position, SAR,
+    acceleration factor and extreme point held in arrays, so the per-bar work
+    is a fixed number of array operations however many symbols there are.
+
+    state is None or a (resumed, position, sar, af, ep) tuple of arrays with
+    one entry per symbol. A symbol with resumed set continues from that state
+    and its arrays must start with the bar the state was saved after; any
+    other symbol opens its first position at its first significant high or low
+    point. As always, the last two bars of each symbol are left for a later
+    run.
+
+    Returns (symbol, bar, position, sar, state). The first four are flat
+    arrays with one entry per output row, grouped by symbol and in bar order,
+    where bar indexes that symbol's input arrays. state is the (opened, bar,
+    position, sar, af, ep) tuple of arrays after the last bar processed for
+    each symbol; symbols that could not open a position have opened unset.
+    """
+    high, lengths = pad(highs)
+    low, _ = pad(lows)
+    n, m = high.shape
+    stop = lengths - 2
+
+    # Significant points: a HIP is a high above both neighbours, a LOP a low
+    # below both. A bar that is both is ignored.
+    hip = np.zeros((n, m), bool)
+    lop = np.zeros((n, m), bool)
+    hip[:, 1:-1] = (high[:, :-2] < high[:, 1:-1]) & (high[:, 1:-1] > high[:, 2:])
+    lop[:, 1:-1] = (low[:, :-2] > low[:, 1:-1]) & (low[:, 1:-1] < low[:, 2:])
+    sig = (hip != lop) & (np.arange(m) < stop[:, None])
+    first = sig.argmax(axis=1)
+    opened = sig[np.arange(n), first]
+
+    # For the first day of entry, SAR is the previous significant point: the
+    # LOP's low if long, the HIP's high if short. The extreme point is the
+    # high (long) or low (short) of the entry day.
+    rows = np.arange(n)
+    nxt = np.minimum(first + 1, m - 1)
+    is_long = lop[rows, first]
+    position = np.where(is_long, LONG, SHORT).astype(np.int8)
+    sar = np.where(is_long, low[rows, first], high[rows, first])
+    ep = np.where(is_long, high[rows, nxt], low[rows, nxt])
+    af = np.empty(n)
+    af.fill(0.02)
+    start = first + 1
+
+    if state is not None:
+        resumed, s_position, s_sar, s_af, s_ep = state
+        resumed = np.asarray(resumed, bool)
+        opened = opened | resumed
+        position = np.where(resumed, s_position, position).astype(np.int8)
+        sar = np.where(resumed, s_sar, sar)
+        af = np.where(resumed, s_af, af)
+        ep = np.where(resumed, s_ep, ep)
+        start = np.where(resumed, 1, start)
+
+    out_position = np.zeros((n, m), np.int8)
+    out_sar = np.zeros((n, m))
+    begin = start[opened].min() if opened.any() else m
+    for t in range(begin, stop.max() if n else 0):
+        active = opened & (t >= start) & (t < stop)
+        out_position[:, t] = position
+        out_sar[:, t] = sar
+
+        low1, low2 = low[:, t - 1], low[:, t]
+        high1, high2 = high[:, t - 1], high[:, t]
+        is_long = position == LONG
+        is_short = ~is_long
+        reverse_long = is_long & (sar > low2)
+        reverse_short = is_short & (sar < high2)
+        reverse = reverse_long | reverse_short
+        new_ep_long = is_long & ~reverse & (high2 > ep)
+        new_ep_short = is_short & ~reverse & (low2 < ep)
+        new_ep = new_ep_long | new_ep_short
+
+        held_ep = np.where(new_ep_long, high2, np.where(new_ep_short, low2, ep))
+        af_diff = af * np.where(is_long, held_ep - sar, sar - held_ep)
+        held_af = np.where(new_ep, np.minimum(af + 0.02, 0.2), af)
+        held_sar = np.where(is_long, sar + af_diff, sar - af_diff)
+        # SAR never moves into the range of the last two bars.
+        held_sar = np.where(is_long & ((held_sar > low1) | (held_sar > low2)), np.minimum(low1, low2), held_sar)
+        held_sar = np.where(is_short & ((held_sar < high1) | (held_sar < high2)), np.maximum(high1, high2), held_sar)
+
+        # On reversal SAR jumps to the old extreme point and the new extreme
+        # point is the current bar's low (now short) or high (now long).
+        next_sar = np.where(reverse, ep, held_sar)
+        next_ep = np.where(reverse_long, low2, np.where(reverse_short, high2, held_ep))
+        next_af = np.where(reverse, 0.02, held_af)
+        next_position = np.where(reverse, -position, position)
+
+        position = np.where(active, next_position, position).astype(np.int8)
+        sar = np.where(active, next_sar, sar)
+        af = np.where(active, next_af, af)
+        ep = np.where(active, next_ep, ep)
+
+    bars = np.arange(m)
+    emitted = opened[:, None] & (bars >= start[:, None]) & (bars < stop[:, None])
+    symbol, bar = np.nonzero(emitted)
+    last = np.maximum(start, stop) - 1
+    return symbol, bar, out_position[emitted], out_sar[emitted], (opened, last, position, sar, af, ep)
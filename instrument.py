@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+This is the "instrument" module.
+
+It measures the pipeline stages and screeners of etf-backtest.py. Functions
+decorated with measure() record their wall time, CPU time, rows written and
+SQL statements whenever recording has been enabled, and cost one check per
+call otherwise. Timings are inclusive: a backtest includes its screeners.
+
+sample usage:
+>>> import instrument, sqlite3
+>>> instrument.enable(profile_dir='profiles')
+>>> c = instrument.TracingConnection(sqlite3.connect('prices.db'))
+>>> ... run stages with c ...
+>>> print instrument.summary()
+"""
+
+import cProfile
+import os
+import time
+from collections import OrderedDict
+from functools import wraps
+
+
+class TracingConnection:
+    """
+    Wraps a sqlite3 connection and counts the SQL run through it. Python 2's
+    sqlite3 has no trace callback, so statements are counted as they are
+    handed to execute, executemany and executescript: calls is the number of
+    those calls and statements the number of statement executions, one per
+    parameter row for executemany. Everything else goes to the connection.
+    """
+
+    def __init__(self, c):
+        self.c = c
+        self.calls = 0
+        self.statements = 0
+
+    def __getattr__(self, name):
+        return getattr(self.c, name)
+
+    def execute(self, *args):
+        self.calls += 1
+        self.statements += 1
+        return self.c.execute(*args)
+
+    def executemany(self, sql, rows):
+        self.calls += 1
+        return self.c.executemany(sql, self._count(rows))
+
+    def executescript(self, script):
+        self.calls += 1
+        self.statements += script.count(';') + 1
+        return self.c.executescript(script)
+
+    def _count(self, rows):
+        for row in rows:
+            self.statements += 1
+            yield row
+
+
+class Record:
+    """
+    Totals of every call of one measured function.
+    """
+
+    def __init__(self, name, kind):
+        self.name = name
+        self.kind = kind
+        self.calls = 0
+        self.wall = 0.
+        self.cpu = 0.
+        self.rows = 0
+        self.statements = 0
+        self.profile = None
+
+    def as_dict(self):
+        return OrderedDict([
+            ('name', self.name),
+            ('kind', self.kind),
+            ('calls', self.calls),
+            ('wall', self.wall),
+            ('cpu', self.cpu),
+            ('rows', self.rows),
+            ('rows_per_sec', self.rows / self.wall if self.wall else 0.),
+            ('statements', self.statements),
+        ])
+
+
+# Records by name in first call order while recording is enabled, None otherwise.
+_records = None
+_profile_dir = None
+_depth = [0]
+
+
+def enable(profile_dir=None):
+    """
+    Starts recording, discarding earlier records. With profile_dir, each
+    measured function is also run under cProfile whenever no other measured
+    function is already being profiled, and dump_profiles() writes one
+    <name>.prof file per function there.
+    """
+    global _records, _profile_dir
+    _records = OrderedDict()
+    _profile_dir = profile_dir
+
+
+def disable():
+    global _records
+    _records = None
+
+
+def cpu_time():
+    # Includes finished child processes, such as sweep's pool workers.
+    return sum(os.times()[:4])
+
+
+def counters(c):
+    return getattr(c, 'total_changes', 0), getattr(c, 'statements', 0)
+
+
+def measure(kind):
+    """
+    Decorates a function whose first argument is a connection, or something
+    that delegates to one, so that its calls are recorded under its name.
+    """
+    def decorate(f):
+        @wraps(f)
+        def run(c, *args, **kwargs):
+            if _records is None:
+                return f(c, *args, **kwargs)
+            record = _records.get(f.__name__)
+            if record is None:
+                record = _records[f.__name__] = Record(f.__name__, kind)
+            changes, statements = counters(c)
+            wall, cpu = time.time(), cpu_time()
+            profile = bool(_profile_dir) and not _depth[0]
+            if profile:
+                record.profile = record.profile or cProfile.Profile()
+                record.profile.enable()
+            _depth[0] += profile
+            try:
+                return f(c, *args, **kwargs)
+            finally:
+                _depth[0] -= profile
+                if profile:
+                    record.profile.disable()
+                record.calls += 1
+                record.wall += time.time() - wall
+                record.cpu += cpu_time() - cpu
+                record.rows += counters(c)[0] - changes
+                record.statements += counters(c)[1] - statements
+        return run
+    return decorate
+
+
+def records():
+    """
+    Returns the records as a list of dicts, ready to be dumped as JSON.
+    """
+    return [r.as_dict() for r in (_records or {}).itervalues()]
+
+
+def summary():
+    """
+    Returns the records as a table, one line per measured function.
+    """
+    lines = ['{:<26} {:<8} {:>6} {:>9} {:>9} {:>9} {:>11} {:>10}'.format(
+        'name', 'kind', 'calls', 'wall', 'cpu', 'rows', 'rows/sec', 'statements')]
+    for r in records():
+        lines.append('{name:<26} {kind:<8} {calls:>6} {wall:>9.3f} {cpu:>9.3f} {rows:>9} {rows_per_sec:>11.0f} {statements:>10}'.format(**r))
+    return '\n'.join(lines)
+
+
+def dump_profiles():
+    """
+    Writes each profiled function's stats to <profile_dir>/<name>.prof and
+    returns the paths written.
+    """
+    if not _profile_dir or not _records:
+        return []
+    if not os.path.isdir(_profile_dir):
+        os.makedirs(_profile_dir)
+    paths = []
+    for r in _records.itervalues():
+        if r.profile:
+            paths.append(os.path.join(_profile_dir, r.name + '.prof'))
+            r.profile.dump_stats(paths[-1])
+    return paths
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+This is the "quotecache" module.
+
+It keeps raw quote responses on disk so repeated downloads of the same history
+are served without any network I/O.
+
+sample usage:
+>>> import quotecache, ystockquote
+>>> cache = quotecache.QuoteCache('.quote_cache')
+>>> rows = ystockquote.get_historical_prices('SPY', '2012-01-01', '2012-12-31', cache=cache)
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+
+class QuoteCache:
+    """
+    Content-addressed cache of response bodies.
+
+    Each key is stored in its own file named by the SHA-1 of the key. A file's
+    mtime is when it was written and is checked against ttl (seconds, None for
+    no expiry). Its atime is bumped on every hit, and the least recently used
+    files are evicted once the directory holds more than max_bytes.
+    """
+
+    def __init__(self, directory, ttl=24 * 60 * 60, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        digest = hashlib.sha1('\0'.join(map(str, key))).hexdigest()
+        return os.path.join(self.directory, digest + '.csv')
+
+    def get(self, key):
+        """
+        Returns the cached body for key, or None if it is missing or expired.
+        """
+        path = self.path(key)
+        with self.lock:
+            try:
+                st = os.stat(path)
+                if self.ttl is not None and time.time() - st.st_mtime > self.ttl:
+                    os.remove(path)
+                    return None
+                with open(path, 'rb') as f:
+                    body = f.read()
+                os.utime(path, (time.time(), st.st_mtime))
+            except (IOError, OSError):
+                return None
+        return body
+
+    def put(self, key, body):
+        path = self.path(key)
+        with self.lock:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+            os.rename(tmp_path, path)
+            self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.csv'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_atime, st.st_size, name))
+            total += st.st_size
+        for atime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            for name in os.listdir(self.directory):
+                if name.endswith('.csv'):
+                    os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+This is the "significance" module.
+
+It tests whether a backtest's edge over SPY could be noise. The monthly
+returns of the strategy and of SPY are resampled many times at once as
+(samples, months) arrays:
+
+- bootstrap() resamples the months in blocks, keeping the strategy's and
+  SPY's returns paired, and gives confidence intervals for the excess total
+  return and excess Sharpe ratio and the share of resamples with no edge.
+- random_portfolios() holds a randomly chosen symbol of the universe each
+  period instead of the screened one, and gives the share of random
+  strategies that did at least as well.
+
+Sharpe ratios are computed as backtest computes them: the mean monthly
+return over the annualized volatility of the monthly returns.
+
+sample usage:
+>>> import significance
+>>> summary = backtest(panel, syms, sharpe_screen2, ())
+>>> boot = significance.bootstrap(summary['returns'], summary['spy_returns'], 10000, seed=1)
+>>> rand = significance.random_portfolios(summary['returns'], period_returns, 10000, seed=1)
+>>> print significance.report(boot, rand)
+"""
+
+from collections import OrderedDict
+import numpy as np
+
+
+def total_return(returns):
+    """
+    Returns the compounded return of each row of returns.
+    """
+    return np.prod(1 + returns, axis=-1) - 1
+
+
+def sharpe(returns):
+    """
+    Returns the Sharpe ratio of each row of returns, as backtest computes it.
+    """
+    n = returns.shape[-1]
+    vol = returns.std(axis=-1, ddof=1 if n > 1 else 0) * 12 ** 0.5
+    return returns.mean(axis=-1) / vol
+
+
+def block_indices(n, samples, block, rng):
+    """
+    Returns a (samples, n) array of month indices made of blocks of block
+    consecutive months, starting anywhere and wrapping around the end.
+    """
+    blocks = -(-n // block)
+    starts = rng.randint(0, n, (samples, blocks, 1))
+    return ((starts + np.arange(block)) % n).reshape(samples, -1)[:, :n]
+
+
+def interval(values, alpha):
+    return tuple(np.percentile(values, [100 * alpha / 2, 100 * (1 - alpha / 2)]).tolist())
+
+
+def bootstrap(returns, spy_returns, samples=10000, block=3, alpha=0.05, seed=None):
+    """
+    Block-bootstraps the paired monthly returns and returns the observed
+    excess total return and excess Sharpe ratio over SPY, their 1 - alpha
+    confidence intervals, and the share of resamples in which each excess
+    was not positive, a one-sided p-value for an edge over SPY.
+    """
+    returns = np.asarray(returns, np.float)
+    spy_returns = np.asarray(spy_returns, np.float)
+    if returns.shape != spy_returns.shape or len(returns) < 2:
+        raise ValueError, "need two equally long series of at least two returns"
+    rng = np.random.RandomState(seed)
+    idx = block_indices(len(returns), samples, block, rng)
+    result = OrderedDict([('method', 'block bootstrap'), ('samples', samples), ('block', block), ('alpha', alpha)])
+    for name, stat in (('excess_return', total_return), ('excess_sharpe', sharpe)):
+        observed = stat(returns) - stat(spy_returns)
+        resampled = stat(returns[idx]) - stat(spy_returns[idx])
+        result[name] = OrderedDict([
+            ('observed', float(observed)),
+            ('interval', interval(resampled, alpha)),
+            ('p_value', float(np.mean(resampled <= 0))),
+        ])
+    return result
+
+
+def random_portfolios(returns, period_returns, samples=10000, seed=None):
+    """
+    Compares returns with strategies that hold one symbol picked at random
+    each period. period_returns is a (periods, symbols) array of every
+    symbol's return over each of the periods returns was earned in, NaN
+    where a symbol could not be held. Returns, for the total return and the
+    Sharpe ratio, the observed value, the median of the random strategies
+    and the share of them that did at least as well, counting the strategy
+    itself.
+    """
+    returns = np.asarray(returns, np.float)
+    period_returns = np.asarray(period_returns, np.float)
+    if period_returns.shape[0] != len(returns):
+        raise ValueError, "period_returns needs one row per return"
+    valid = ~np.isnan(period_returns)
+    counts = valid.sum(axis=1)
+    if not counts.all():
+        raise ValueError, "every period needs at least one symbol that could be held"
+    rng = np.random.RandomState(seed)
+    # Valid symbols first in each row, so a pick below the row's count is a valid symbol.
+    order = np.argsort(~valid, axis=1, kind='mergesort')
+    periods = np.arange(len(returns))
+    picks = (rng.rand(samples, len(returns)) * counts).astype(np.int)
+    random_returns = period_returns[periods, order[periods, picks]]
+    result = OrderedDict([('method', 'random portfolios'), ('samples', samples)])
+    for name, stat in (('return', total_return), ('sharpe', sharpe)):
+        observed = stat(returns)
+        random = stat(random_returns)
+        result[name] = OrderedDict([
+            ('observed', float(observed)),
+            ('median', float(np.median(random))),
+            ('p_value', float((1 + np.sum(random >= observed)) / (1. + samples))),
+        ])
+    return result
+
+
+def report(*results):
+    """
+    Returns the results of bootstrap() and random_portfolios() as text.
+    """
+    lines = []
+    for result in results:
+        lines.append('{} ({} samples)'.format(result['method'], result['samples']))
+        for name, stats in result.iteritems():
+            if not isinstance(stats, dict):
+                continue
+            if 'interval' in stats:
+                lines.append('{:>16}: {:8.4f}  {:.0%} interval [{:8.4f}, {:8.4f}]  p = {:.4f}'.format(
+                    name, stats['observed'], 1 - result['alpha'], stats['interval'][0], stats['interval'][1], stats['p_value']))
+            else:
+                lines.append('{:>16}: {:8.4f}  random median {:8.4f}  p = {:.4f}'.format(
+                    name, stats['observed'], stats['median'], stats['p_value']))
+    return '\n'.join(lines)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+This is the "synthetic" module.
+
+It generates market data for runs that need no network access, such as the
+benchmark and the query plan check of etf-backtest.py. Quotes are geometric
+random walks on weekdays, fully determined by a seed and the symbol, and are
+handed to etf.insert_quotes through synthetic_fetch in place of downloads.
+
+sample usage:
+>>> import synthetic
+>>> syms = synthetic.synthetic_symbols(100)
+>>> etf.insert_quotes(c, '2005-03-03', '2013-03-03', fetch=synthetic.synthetic_fetch(seed=1))
+"""
+
+import datetime
+import numpy as np
+
+TRADING_DAYS = 252
+
+
+def synthetic_symbols(n):
+    """
+    Returns n symbol names. SPY is always among them since backtest measures
+    against it.
+    """
+    return ['SPY'] + ['S{:04d}'.format(i) for i in range(1, n)]
+
+
+def trading_days(start_date, end_date):
+    """
+    Returns the weekdays from start_date through end_date.
+    """
+    day = datetime.date(*map(int, start_date.split('-')))
+    end = datetime.date(*map(int, end_date.split('-')))
+    days = []
+    while day <= end:
+        if day.weekday() < 5:
+            days.append(day)
+        day += datetime.timedelta(1)
+    return days
+
+
+def synthetic_quotes(sym, days, seed):
+    """
+    Returns [sym, dt, open, high, low, close, volume, adjClose] ticks for a
+    geometric random walk over days, rounded to cents as downloaded quotes
+    are. The walk is fully determined by seed and sym, and a quarter of the
+    symbols start trading partway through the history.
+    """
+    rng = np.random.RandomState([seed] + map(ord, sym))
+    if sym != 'SPY' and rng.rand() < 0.25:
+        days = days[rng.randint(len(days) // 2):]
+    n = len(days)
+    drift = rng.normal(0.05, 0.05) / TRADING_DAYS
+    vol = rng.uniform(0.1, 0.4) / TRADING_DAYS ** 0.5
+    close = rng.uniform(20, 200) * np.exp(np.cumsum(rng.normal(drift - vol * vol / 2, vol, n)))
+    open_ = np.concatenate(([close[0]], close[:-1])) * np.exp(rng.normal(0, vol / 4, n))
+    high = np.maximum(open_, close) * np.exp(np.abs(rng.normal(0, vol / 2, n)))
+    low = np.minimum(open_, close) * np.exp(-np.abs(rng.normal(0, vol / 2, n)))
+    volume = np.round(rng.lognormal(13, 1, n))
+    close, open_, high, low = [np.round(a, 2) for a in (close, open_, high, low)]
+    return [[sym, dt, o, h, l, cl, v, cl]
+            for dt, o, h, l, cl, v in zip(days, open_.tolist(), high.tolist(), low.tolist(), close.tolist(), volume.tolist())]
+
+
+def synthetic_fetch(seed):
+    """
+    Returns a fetch function for etf.insert_quotes that generates each job's
+    quotes instead of downloading them.
+    """
+    def fetch(jobs, workers, **kwargs):
+        for sym, start_date, end_date in jobs:
+            yield sym, synthetic_quotes(sym, trading_days(start_date, end_date), seed)
+    return fetch
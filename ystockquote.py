@@ -10,7 +10,13 @@
 #  version 2.1 of the License, or (at your option) any later version.
 
 
+import csv
+import httplib
+import socket
 import urllib
+import urllib2
+import urlparse
+from StringIO import StringIO
 
 
 """
@@ -22,11 +28,21 @@ sample usage:
 >>> import ystockquote
 >>> print ystockquote.get_price('GOOG')
 529.46
+>>> quotes = ystockquote.get_many(['SPY', 'TLT'], ['price', 'volume'])
+>>> print quotes['SPY']['volume']
+135542000
 """
 
 
+HISTORICAL_URL = 'http://ichart.yahoo.com/table.csv'
+QUOTES_URL = 'http://finance.yahoo.com/d/quotes.csv'
+
+# Symbols per quotes.csv request made by QuoteClient.
+QUOTES_CHUNK = 200
+
+
 def __request(symbol, stat):
-    url = 'http://finance.yahoo.com/d/quotes.csv?s=%s&f=%s' % (symbol, stat)
+    url = QUOTES_URL + '?s=%s&f=%s' % (symbol, stat)
     return urllib.urlopen(url).read().strip().strip('"')
 
 
@@ -141,14 +157,155 @@ def get_short_ratio(symbol):
     return __request(symbol, 's7')
     
     
-def get_historical_prices(symbol, start_date, end_date):
+def parse_number(value):
     """
-    Get historical prices for the given ticker symbol.
-    Date format is 'YYYY-MM-DD'
-    
-    Returns a nested list.
+    Parses a quotes.csv number such as '+1.25', '3.1%' or '12.5B'.
+    Returns None for 'N/A' and other values that are not numbers.
+    """
+    value = value.strip().rstrip('%').replace(',', '')
+    scale = {'K': 1e3, 'M': 1e6, 'B': 1e9, 'T': 1e12}.get(value[-1:].upper())
+    if scale:
+        value = value[:-1]
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    return number * scale if scale else number
+
+
+def parse_int(value):
+    number = parse_number(value)
+    return None if number is None else int(number)
+
+
+def parse_str(value):
+    return None if value == 'N/A' else value
+
+
+# get_all()'s fields in order, each with its quotes.csv tag and parser.
+FIELDS = [
+    ('price', 'l1', parse_number),
+    ('change', 'c1', parse_number),
+    ('volume', 'v', parse_int),
+    ('avg_daily_volume', 'a2', parse_int),
+    ('stock_exchange', 'x', parse_str),
+    ('market_cap', 'j1', parse_number),
+    ('book_value', 'b4', parse_number),
+    ('ebitda', 'j4', parse_number),
+    ('dividend_per_share', 'd', parse_number),
+    ('dividend_yield', 'y', parse_number),
+    ('earnings_per_share', 'e', parse_number),
+    ('52_week_high', 'k', parse_number),
+    ('52_week_low', 'j', parse_number),
+    ('50day_moving_avg', 'm3', parse_number),
+    ('200day_moving_avg', 'm4', parse_number),
+    ('price_earnings_ratio', 'r', parse_number),
+    ('price_earnings_growth_ratio', 'r5', parse_number),
+    ('price_sales_ratio', 'p5', parse_number),
+    ('price_book_ratio', 'p6', parse_number),
+    ('short_ratio', 's7', parse_number),
+]
+FIELD_NAMES = [name for name, tag, parse in FIELDS]
+
+
+class QuoteClient:
+    """
+    Fetches quotes.csv snapshots for many symbols at once, QUOTES_CHUNK
+    symbols per request, over one keep-alive HTTP connection that is
+    reopened if the server has closed it.
+
+    sample usage:
+    >>> client = ystockquote.QuoteClient(timeout=10)
+    >>> quotes = client.get(['SPY', 'TLT'], ['price', 'volume'])
+    >>> quotes['SPY']['price']
+    151.61
+    >>> client.close()
+    """
+
+    def __init__(self, url=QUOTES_URL, chunk=QUOTES_CHUNK, timeout=None):
+        parts = urlparse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path
+        self.chunk = chunk
+        self.timeout = timeout
+        self.connection = None
+        self.requests = 0
+
+    def get(self, symbols, fields=FIELD_NAMES):
+        """
+        Returns a dictionary of symbol -> dictionary of the named fields,
+        parsed into numbers, or None where quotes.csv has no value.
+        """
+        specs = dict((name, (tag, parse)) for name, tag, parse in FIELDS)
+        unknown = [name for name in fields if name not in specs]
+        if unknown:
+            raise ValueError, "unknown fields: %s" % ', '.join(unknown)
+        # The symbol comes first so rows can be matched to symbols.
+        tags = 's' + ''.join(specs[name][0] for name in fields)
+        quotes = {}
+        symbols = list(symbols)
+        for i in range(0, len(symbols), self.chunk):
+            query = urllib.urlencode([('s', ' '.join(symbols[i:i + self.chunk])), ('f', tags)])
+            for row in csv.reader(StringIO(self._fetch(self.path + '?' + query))):
+                if len(row) != len(fields) + 1:
+                    continue
+                quotes[row[0]] = dict((name, specs[name][1](value)) for name, value in zip(fields, row[1:]))
+        return quotes
+
+    def _fetch(self, path):
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.connection.request('GET', path, headers={'Connection': 'keep-alive'})
+                response = self.connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                # A kept-alive connection the server has since closed fails on first use; retry on a new one.
+                self.close()
+                if attempt:
+                    raise
+                continue
+            self.requests += 1
+            if response.status != 200:
+                raise IOError, "quotes.csv request failed: %s %s" % (response.status, response.reason)
+            if response.will_close:
+                self.close()
+            return body
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def get_many(symbols, fields, timeout=None):
     """
-    url = 'http://ichart.yahoo.com/table.csv?s=%s&' % symbol + \
+    Get the named fields, a subset of FIELD_NAMES, for many ticker symbols
+    with a few batched requests.
+
+    Returns a dictionary of symbol -> dictionary of typed values.
+    """
+    client = QuoteClient(timeout=timeout)
+    try:
+        return client.get(symbols, fields)
+    finally:
+        client.close()
+
+
+def get_all_many(symbols, timeout=None):
+    """
+    Get all available quote data for many ticker symbols with a few
+    batched requests.
+
+    Returns a dictionary of symbol -> dictionary with get_all()'s keys.
+    """
+    return get_many(symbols, FIELD_NAMES, timeout)
+
+
+def __historical_url(symbol, start_date, end_date):
+    return HISTORICAL_URL + '?s=%s&' % symbol + \
           'd=%s&' % str(int(end_date[5:7]) - 1) + \
           'e=%s&' % str(int(end_date[8:10])) + \
           'f=%s&' % str(int(end_date[0:4])) + \
@@ -157,6 +314,55 @@ def get_historical_prices(symbol, start_date, end_date):
           'b=%s&' % str(int(start_date[8:10])) + \
           'c=%s&' % str(int(start_date[0:4])) + \
           'ignore=.csv'
-    days = urllib.urlopen(url).readlines()
+
+
+def __historical_lines(symbol, start_date, end_date, timeout, cache):
+    url = __historical_url(symbol, start_date, end_date)
+    key = (symbol, start_date, end_date)
+    body = cache.get(key) if cache is not None else None
+    if body is not None:
+        return StringIO(body)
+    if timeout is None:
+        response = urllib2.urlopen(url)
+    else:
+        response = urllib2.urlopen(url, timeout=timeout)
+    if cache is None:
+        return response
+    # The whole body is needed to store it.
+    body = response.read()
+    cache.put(key, body)
+    return StringIO(body)
+
+
+def get_historical_prices(symbol, start_date, end_date, timeout=None, cache=None):
+    """
+    Get historical prices for the given ticker symbol.
+    Date format is 'YYYY-MM-DD'
+    timeout is in seconds and bounds each blocking socket operation.
+    cache is an optional quotecache.QuoteCache; hits skip the network.
+    
+    Returns a nested list.
+    """
+    days = __historical_lines(symbol, start_date, end_date, timeout, cache).readlines()
     data = [day[:-2].split(',') for day in days]
     return data
+
+
+def iter_historical_prices(symbol, start_date, end_date, timeout=None, cache=None):
+    """
+    Get historical prices for the given ticker symbol, one day at a time
+    as the response is read, so memory use does not grow with the length
+    of the history. Arguments are as for get_historical_prices.
+
+    Yields (date, open, high, low, close, volume, adj_close) tuples, the
+    date as its 'YYYY-MM-DD' string and the rest as floats. The header
+    line is skipped.
+    """
+    lines = __historical_lines(symbol, start_date, end_date, timeout, cache)
+    lines.readline()
+    for line in lines:
+        fields = line.rstrip('\r\n').split(',')
+        if len(fields) != 7:
+            continue
+        yield (fields[0], float(fields[1]), float(fields[2]), float(fields[3]), float(fields[4]),
+               float(fields[5]), float(fields[6]))